@@ -1,5 +1,11 @@
 
 import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
 A1111_DIR = os.environ.get("A1111_DIR", "/workspace/stable-diffusion-webui")
@@ -8,12 +14,35 @@ MODELS_CN = os.path.join(A1111_DIR, "models", "ControlNet")
 os.makedirs(MODELS_SD, exist_ok=True)
 os.makedirs(MODELS_CN, exist_ok=True)
 
-CIV_BASE = "https://civitai.com/api/v1"
+CIV_BASE = os.environ.get("CIVITAI_BASE", "https://civitai.com/api/v1")
 CIVITAI_API_KEY = os.environ.get("CIVITAI_API_KEY", "")
 
+# Multi-GB files are fetched as this many parallel HTTP Range segments
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+# Files smaller than this are fetched over one connection
+SEGMENT_MIN_MB = int(os.environ.get("DOWNLOAD_SEGMENT_MIN_MB", "64"))
+CHUNK = 1024 * 1024
+
+# query -> model version -> file -> sha256, so warm restarts skip search and download
+LOCK_PATH = os.environ.get("MODELS_LOCK", os.path.join(A1111_DIR, "models", "models.lock.json"))
+# Re-check a resolution with Civitai after this many hours; 0 keeps it pinned
+LOCK_TTL_H = float(os.environ.get("MODELS_LOCK_TTL_H", "0"))
+OFFLINE = os.environ.get("MODELS_OFFLINE", "") not in ("", "0", "false")
+
+# One lock per target file: concurrent queries can resolve to the same file
+_targets = {}
+_targets_lock = threading.Lock()
+
+
+def target_lock(out):
+    with _targets_lock:
+        return _targets.setdefault(os.path.abspath(out), threading.Lock())
+
 
-def civ_get(path, params=None, stream=False):
+def civ_get(path, params=None, stream=False, etag=None):
     headers = {"Authorization": f"Bearer {CIVITAI_API_KEY}"} if CIVITAI_API_KEY else {}
+    if etag:
+        headers["If-None-Match"] = etag
     r = requests.get(f"{CIV_BASE}{path}", params=params, headers=headers, stream=stream, timeout=600)
     r.raise_for_status()
     return r
@@ -42,9 +71,198 @@ def pick(ver):
     return files[0] if files else None
 
 
-def search_and_download(query, model_type, out_dir):
+def auth_headers():
+    return {"Authorization": f"Bearer {CIVITAI_API_KEY}"} if CIVITAI_API_KEY else {}
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(8 * CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def probe(url):
+    """Follow redirects to the real file URL; return (url, total size or None, ranges supported)."""
+    with requests.get(url, headers={**auth_headers(), "Range": "bytes=0-0"}, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        if r.status_code == 206 and "/" in r.headers.get("Content-Range", ""):
+            total = r.headers["Content-Range"].rsplit("/", 1)[1]
+            if total.isdigit():
+                return r.url, int(total), True
+        size = r.headers.get("Content-Length")
+        return r.url, int(size) if size and size.isdigit() else None, False
+
+
+def plan_segments(total, ranges):
+    if not ranges or not total:
+        # One plain stream; without Range support it cannot resume
+        return [[0, None, 0]]
+    n = max(1, min(DOWNLOAD_CONNECTIONS, total // (SEGMENT_MIN_MB * CHUNK)))
+    step = -(-total // n)
+    return [[start, min(start + step, total) - 1, 0] for start in range(0, total, step)]
+
+
+def fetch_segment(url, part, seg, state, headers):
+    start, end, done = seg
+    if end is not None and start + done > end:
+        return
+    headers = dict(headers)
+    if end is not None:
+        headers["Range"] = f"bytes={start + done}-{end}"
+    with requests.get(url, headers=headers, stream=True, timeout=(30, 600)) as r:
+        r.raise_for_status()
+        if end is not None and r.status_code != 206:
+            raise RuntimeError(f"server ignored Range request (HTTP {r.status_code})")
+        with open(part, "r+b") as fp:
+            fp.seek(start + done)
+            for ch in r.iter_content(CHUNK):
+                if ch:
+                    fp.write(ch)
+                    state.advance(seg, len(ch))
+
+
+class PartState:
+    """Progress of a .part file, kept next to it so an interrupted download resumes."""
+
+    def __init__(self, part, url, total, segments):
+        self.path = part + ".json"
+        self.url = url
+        self.total = total
+        self.segments = segments
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    @classmethod
+    def load(cls, part, total):
+        try:
+            with open(part + ".json") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if data.get("total") != total or not os.path.exists(part):
+            return None
+        return cls(part, data.get("url"), total, data["segments"])
+
+    def advance(self, seg, n):
+        with self._lock:
+            seg[2] += n
+        self.save()
+
+    def save(self, force=False):
+        # Flushed every 64 MB of progress; the hash check catches anything written but not recorded.
+        # Progress is snapshotted under the lock so segment threads never leave a torn state.
+        with self._lock:
+            done = sum(s[2] for s in self.segments)
+            if not force and done - self._saved < 64 * CHUNK:
+                return
+            self._saved = done
+            snapshot = {"url": self.url, "total": self.total, "segments": [list(s) for s in self.segments]}
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as fp:
+                json.dump(snapshot, fp)
+            os.replace(tmp, self.path)
+
+
+def download(url, out, sha256=None):
+    """Download `url` to `out` via `out.part`, resuming and verifying sha256 before the atomic rename."""
+    part = out + ".part"
+    real_url, total, ranges = probe(url)
+    state = PartState.load(part, total) if ranges else None
+    if state is None:
+        state = PartState(part, real_url, total, plan_segments(total, ranges))
+        with open(part, "wb") as fp:
+            if total:
+                fp.truncate(total)
+    else:
+        print(f"[*] Resume {os.path.basename(out)} at {sum(s[2] for s in state.segments) / CHUNK:.0f} MB")
+    state.url = real_url
+    state.save(force=True)
+    # Signed storage URLs behind the Civitai redirect reject an extra Authorization header
+    headers = auth_headers() if real_url == url else {}
+
+    try:
+        if len(state.segments) == 1:
+            fetch_segment(real_url, part, state.segments[0], state, headers)
+        else:
+            with ThreadPoolExecutor(len(state.segments)) as pool:
+                for fut in [pool.submit(fetch_segment, real_url, part, seg, state, headers) for seg in state.segments]:
+                    fut.result()
+    finally:
+        state.save(force=True)
+
+    if sha256:
+        got = sha256_file(part)
+        if got.lower() != sha256.lower():
+            os.remove(part)
+            os.remove(state.path)
+            raise RuntimeError(f"sha256 mismatch for {os.path.basename(out)}: {got} != {sha256}")
+    os.replace(part, out)
+    os.remove(state.path)
+
+
+class ModelLock:
+    """JSON lockfile of resolved models, keyed by "<type>:<query>".
+
+    Each entry pins the model/version ids, file name, download URL and SHA256 that a search
+    resolved to, plus the search response ETag and the size/mtime of the verified local file.
+    """
+
+    def __init__(self, path=LOCK_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        with self._lock:
+            return dict(self.entries[key]) if key in self.entries else None
+
+    def uses(self, file, model_type, skip_key=None):
+        """True if an entry other than skip_key pins `file` for model_type."""
+        with self._lock:
+            return any(k != skip_key and e.get("file") == file and e.get("type") == model_type
+                       for k, e in self.entries.items())
+
+    def put(self, key, entry):
+        with self._lock:
+            self.entries[key] = entry
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as fp:
+                json.dump(self.entries, fp, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+def verified(entry, out):
+    """True if `out` is the pinned file. Rehashes only when size or mtime changed since last verified."""
+    try:
+        st = os.stat(out)
+    except OSError:
+        return False
+    if entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+        return True
+    if not entry.get("sha256"):
+        # Nothing to check against; accept an existing file as before
+        if entry.get("size") not in (None, st.st_size):
+            return False
+    elif sha256_file(out).lower() != entry["sha256"].lower():
+        return False
+    entry["size"], entry["mtime_ns"] = st.st_size, st.st_mtime_ns
+    return True
+
+
+def resolve(query, model_type, etag=None):
+    """Search Civitai; returns (entry, None) or (None, etag) if the response is unchanged (HTTP 304)."""
     print(f"[*] Search {model_type}: {query}")
-    items = civ_get("/models", params={"query": query, "types": model_type, "limit": 10}).json().get("items") or []
+    r = civ_get("/models", params={"query": query, "types": model_type, "limit": 10}, etag=etag)
+    if r.status_code == 304:
+        return None, etag
+    items = r.json().get("items") or []
     
     if not items:
         raise RuntimeError("No results")
@@ -52,46 +270,95 @@ def search_and_download(query, model_type, out_dir):
     items.sort(key=lambda it: (it.get("stats", {}).get("downloadCount", 0), it.get("modelVersions", [{}])[0].get("id", 0)), reverse=True)
     ver = items[0].get("modelVersions", [{}])[0]
     f = pick(ver)
-    url = f.get("downloadUrl")
-    name = f.get("name")
     
-    if not url:
+    if not f or not f.get("downloadUrl"):
         raise RuntimeError("no downloadUrl")
     
+    entry = {
+        "query": query,
+        "type": model_type,
+        "model_id": items[0].get("id"),
+        "version_id": ver.get("id"),
+        "file": f.get("name"),
+        "url": f.get("downloadUrl"),
+        "sha256": (f.get("hashes") or {}).get("SHA256"),
+        "etag": r.headers.get("ETag"),
+    }
+    return entry, None
+
+
+def search_and_download(query, model_type, out_dir, lock=None):
+    lock = lock or ModelLock()
+    key = f"{model_type}:{query}"
+    entry = lock.get(key)
+    fresh = entry and (OFFLINE or not LOCK_TTL_H or time.time() - entry.get("resolved_at", 0) < LOCK_TTL_H * 3600)
+    
+    replaced = None
+    if entry and not fresh:
+        # TTL expired: revalidate the search with its ETag and keep the pin if nothing changed
+        try:
+            new, _ = resolve(query, model_type, etag=entry.get("etag"))
+        except (requests.RequestException, ValueError) as e:
+            # Network down, DNS, Civitai 5xx: a pinned file that still verifies is good enough
+            pinned = os.path.join(out_dir, entry["file"])
+            if not verified(entry, pinned):
+                raise
+            print(f"[WARN] {key}: revalidation failed ({e}); using pinned {entry['file']}")
+            print("[OK]", pinned)
+            return pinned
+        if new and (new["version_id"], new["file"], new["sha256"]) != (entry["version_id"], entry["file"], entry["sha256"]):
+            print(f"[*] {key} now resolves to version {new['version_id']} ({new['file']})")
+            if new["file"] != entry["file"]:
+                replaced = entry["file"]
+            entry = new
+        elif new:
+            entry["etag"] = new["etag"]
+        entry["resolved_at"] = time.time()
+    elif not entry:
+        if OFFLINE:
+            raise RuntimeError(f"offline and {key} is not in {lock.path}")
+        entry, _ = resolve(query, model_type)
+        entry["resolved_at"] = time.time()
+    
     os.makedirs(out_dir, exist_ok=True)
-    out = os.path.join(out_dir, name)
+    out = os.path.join(out_dir, entry["file"])
     
-    if not os.path.exists(out):
-        headers = {"Authorization": f"Bearer {CIVITAI_API_KEY}"} if CIVITAI_API_KEY else {}
-        with requests.get(url, headers=headers, stream=True, timeout=1800) as rr:
-            rr.raise_for_status()
-            with open(out, "wb") as fp:
-                for ch in rr.iter_content(1024 * 1024):
-                    if ch:
-                        fp.write(ch)
+    # A second query resolving to the same file waits here and then finds it verified
+    with target_lock(out):
+        if not verified(entry, out):
+            if OFFLINE:
+                raise RuntimeError(f"offline and {out} is missing or does not match the lockfile")
+            download(entry["url"], out, entry["sha256"])
+            st = os.stat(out)
+            entry["size"], entry["mtime_ns"] = st.st_size, st.st_mtime_ns
     
+    if entry != lock.get(key):
+        lock.put(key, entry)
+    # The superseded file is no longer pinned; drop it unless another query still uses it
+    old = os.path.join(out_dir, replaced) if replaced else None
+    if old and os.path.exists(old) and not lock.uses(replaced, model_type, skip_key=key):
+        with target_lock(old):
+            os.remove(old)
+        print(f"[*] Removed superseded {old}")
     print("[OK]", out)
     return out
 
 
 def main():
-    try:
-        sdxl = search_and_download(os.environ.get("SDXL_CIVITAI_QUERY", "Realism Engine SDXL"), "Checkpoint", MODELS_SD)
-        print("SDXL_CHECKPOINT=", os.path.basename(sdxl))
-    except Exception as e:
-        print("[WARN] SDXL:", e)
-    
-    try:
-        cn0 = search_and_download(os.environ.get("CONTROLNET_CIVITAI_QUERY", "softedge sdxl dexined"), "Controlnet", MODELS_CN)
-        print("CONTROLNET0_FILE=", os.path.basename(cn0))
-    except Exception as e:
-        print("[WARN] ControlNet0:", e)
-    
-    try:
-        cn1 = search_and_download(os.environ.get("CONTROLNET2_CIVITAI_QUERY", "canny sdxl"), "Controlnet", MODELS_CN)
-        print("CONTROLNET1_FILE=", os.path.basename(cn1))
-    except Exception as e:
-        print("[WARN] ControlNet1:", e)
+    jobs = [
+        ("SDXL", "SDXL_CHECKPOINT", os.environ.get("SDXL_CIVITAI_QUERY", "Realism Engine SDXL"), "Checkpoint", MODELS_SD),
+        ("ControlNet0", "CONTROLNET0_FILE", os.environ.get("CONTROLNET_CIVITAI_QUERY", "softedge sdxl dexined"), "Controlnet", MODELS_CN),
+        ("ControlNet1", "CONTROLNET1_FILE", os.environ.get("CONTROLNET2_CIVITAI_QUERY", "canny sdxl"), "Controlnet", MODELS_CN),
+    ]
+    lock = ModelLock()
+    # The three artifacts download concurrently; results are reported in the usual order
+    with ThreadPoolExecutor(len(jobs)) as pool:
+        futures = [pool.submit(search_and_download, query, model_type, out_dir, lock) for _, _, query, model_type, out_dir in jobs]
+        for (label, var, *_), fut in zip(jobs, futures):
+            try:
+                print(f"{var}= {os.path.basename(fut.result())}")
+            except Exception as e:
+                print(f"[WARN] {label}:", e)
 
 
 if __name__ == "__main__":
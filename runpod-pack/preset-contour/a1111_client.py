@@ -0,0 +1,185 @@
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class BackendError(RuntimeError):
+    """The A1111 backend failed to serve a request; safe to retry elsewhere."""
+
+
+class StallError(BackendError):
+    """A running job made no progress for stall_timeout_s and was interrupted."""
+
+
+RETRY_STATUS = {500, 502, 503, 504}
+
+
+class A1111Client:
+    """Keep-alive HTTP client for one A1111 server.
+
+    - connections come from a pooled requests.Session
+    - ensure_ready() probes /sdapi/v1/sd-models before first use
+    - connection errors and 5xx responses are retried with exponential backoff and full jitter
+    - img2img() watches /sdapi/v1/progress and calls /sdapi/v1/interrupt when the job stalls,
+      so a hung job costs stall_timeout_s rather than the blanket request timeout. The interrupt
+      is server-wide, so it is only sent while this is the client's only img2img in flight.
+    """
+
+    def __init__(self, url, session=None, pool_size=4, connect_timeout_s=10.0, request_timeout_s=900.0, retries=3,
+                 backoff_s=1.0, backoff_max_s=30.0, stall_timeout_s=180.0, progress_poll_s=2.0, ready_timeout_s=600.0):
+        self.url = url.rstrip("/")
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(2, int(pool_size)))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.connect_timeout_s = float(connect_timeout_s)
+        self.request_timeout_s = float(request_timeout_s)
+        self.retries = max(0, int(retries))
+        self.backoff_s = float(backoff_s)
+        self.backoff_max_s = float(backoff_max_s)
+        self.stall_timeout_s = float(stall_timeout_s)
+        self.progress_poll_s = float(progress_poll_s)
+        self.ready_timeout_s = float(ready_timeout_s)
+        self.ready = False
+        self.ever_ready = False
+        self.boot_deadline = None  # end of the one boot window, set on the first probe
+        self.retried = 0
+        self.interrupted = 0
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_cfg(cls, cfg, url, session=None):
+        cc = cfg.get("client") or {}
+        return cls(url, session=session, **cc)
+
+    def _backoff(self, attempt):
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_s * (2 ** attempt)))
+
+    def request(self, method, path, timeout=None, retry=True, **kwargs):
+        timeout = timeout or (self.connect_timeout_s, self.request_timeout_s)
+        attempts = self.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            try:
+                r = self.session.request(method, f"{self.url}{path}", timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.exceptions.ConnectTimeout):
+                if attempt + 1 >= attempts:
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUS or attempt + 1 >= attempts:
+                    return r
+            self.retried += 1
+            time.sleep(self._backoff(attempt))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def ensure_ready(self):
+        """Block until /sdapi/v1/sd-models answers (server up, models listed).
+
+        A server that has never answered gets one ready_timeout_s window to boot, counted from
+        the first probe; after that window, or once it was up and then failed, each call makes a
+        single probe, so callers can fail over quickly.
+        """
+        if self.ready:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self.boot_deadline is None:
+                self.boot_deadline = now + self.ready_timeout_s
+        deadline = now if self.ever_ready else self.boot_deadline
+        attempt = 0
+        while True:
+            try:
+                r = self.session.get(f"{self.url}/sdapi/v1/sd-models", timeout=(self.connect_timeout_s, 30))
+                if r.status_code == 200:
+                    self.ready = self.ever_ready = True
+                    return
+            except requests.RequestException:
+                pass
+            if time.monotonic() >= deadline:
+                raise BackendError(f"{self.url} not ready (/sdapi/v1/sd-models)")
+            time.sleep(min(self._backoff(attempt) + 0.5, max(0.0, deadline - time.monotonic())))
+            attempt += 1
+
+    def _watch(self, stop, state):
+        last_sig, last_change = None, time.monotonic()
+        while not stop.wait(self.progress_poll_s):
+            try:
+                p = self.session.get(f"{self.url}/sdapi/v1/progress", params={"skip_current_image": "true"},
+                                     timeout=(self.connect_timeout_s, 10)).json()
+            except (requests.RequestException, ValueError):
+                # Busy or unreachable progress endpoint; the request timeout still bounds the job
+                continue
+            st = p.get("state") or {}
+            sig = (p.get("progress"), st.get("job"), st.get("job_no"), st.get("sampling_step"), st.get("job_timestamp"))
+            now = time.monotonic()
+            if sig != last_sig:
+                last_sig, last_change = sig, now
+            elif now - last_change >= self.stall_timeout_s:
+                with self._lock:
+                    alone = self.inflight == 1
+                if not alone:
+                    # /sdapi/v1/interrupt would hit whichever job is running, maybe a healthy one;
+                    # leave this one to request_timeout_s
+                    print(f"[CLIENT] {self.url}: no progress for {self.stall_timeout_s:.0f}s with "
+                          f"{self.inflight} jobs in flight; not interrupting")
+                    return
+                state["stalled"] = True
+                self.interrupted += 1
+                try:
+                    self.session.post(f"{self.url}/sdapi/v1/interrupt", timeout=(self.connect_timeout_s, 10))
+                except requests.RequestException:
+                    pass
+                return
+
+    def img2img(self, body, retry=True):
+        """POST a JSON-encoded img2img body under the stall watchdog.
+
+        retry=False sends it once: callers that requeue failed jobs themselves (the dispatcher)
+        must not also retry here, since every attempt is a full generation.
+        """
+        attempts = self.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            try:
+                r = self._img2img_once(body)
+            except (StallError, requests.ConnectionError, requests.exceptions.ConnectTimeout):
+                if attempt + 1 >= attempts:
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUS or attempt + 1 >= attempts:
+                    return r
+            self.retried += 1
+            time.sleep(self._backoff(attempt))
+
+    def _img2img_once(self, body):
+        # A fresh watchdog per attempt, so a stall in one attempt never fails a later one
+        stop = threading.Event()
+        state = {"stalled": False}
+        watcher = None
+        with self._lock:
+            self.inflight += 1
+        try:
+            if self.stall_timeout_s > 0:
+                watcher = threading.Thread(target=self._watch, args=(stop, state), daemon=True)
+                watcher.start()
+            r = self.post("/sdapi/v1/img2img", data=body, headers={"Content-Type": "application/json"}, retry=False)
+        finally:
+            stop.set()
+            if watcher:
+                watcher.join()
+            with self._lock:
+                self.inflight -= 1
+        if state["stalled"]:
+            raise StallError(f"{self.url}: no progress for {self.stall_timeout_s:.0f}s, job interrupted")
+        return r
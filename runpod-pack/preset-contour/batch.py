@@ -1,10 +1,23 @@
 
 import os
+import json
+import time
 import argparse
 import subprocess
 import sys
 import yaml
 import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import run_a_pass
+import run_b_pass
+import spans
+import writer
+from dispatch import Dispatcher
+from manifest import Manifest, stage_hashes
+
+IMAGE_PATTERNS = ("*.png", "*.jpg", "*.jpeg", "*.webp")
 
 
 def load_cfg(path):
@@ -12,9 +25,173 @@ def load_cfg(path):
         return yaml.safe_load(f)
 
 
+def submit_b(dispatcher, prepared):
+    """Queue prepared B-pass requests (one img2img call) on the dispatcher."""
+    # The dispatcher retries on another backend; client-level img2img retries would multiply generations
+    job = lambda backend: run_b_pass.post_img2img(backend.client, prepared, retry=False)
+    return dispatcher.submit(job, affinity=prepared[0][1].get("affinity"))
+
+
+def print_summary(results, dispatcher=None):
+    results = [r for r in results if r]
+    if not results:
+        return
+    sent = sum(r["request_bytes"] for r in results)
+    saved = sum(r["saved_bytes"] for r in results)
+    rtt = sorted(r["rtt_s"] for r in results)
+    print(f"\n[SUMMARY] {len(results)} images, requests {sent / 1e6:.1f} MB (saved {saved / 1e6:.1f} MB vs full-res upload), "
+          f"round trip median {rtt[len(rtt) // 2]:.2f}s max {rtt[-1]:.2f}s")
+    if dispatcher is not None:
+        print(f"[SUMMARY] checkpoint switches {dispatcher.switches} ({dispatcher.switch_time_s:.1f}s), "
+              f"ControlNet model set changes {dispatcher.cn_switches}")
+
+
+class RunLog:
+    """Stage outcomes of one batch run, mirrored into the manifest when there is one."""
+
+    def __init__(self, cfg, manifest=None, history=None):
+        # history keeps only the last N results / failed names, for long-lived processes (watch.py)
+        self.manifest = manifest
+        self.a_hash, self.b_hash = stage_hashes(cfg)
+        self.results = deque(maxlen=history) if history else []
+        self.failed = deque(maxlen=history) if history else []
+        self.n_done = 0
+        self.n_failed = 0
+
+    def a_done(self, name):
+        if self.manifest:
+            self.manifest.mark(name, "a", "done", stage_hash=self.a_hash)
+
+    def a_failed(self, name, err):
+        print(f"[FAILED] A-pass {name}: {err}")
+        self.failed.append(name)
+        self.n_failed += 1
+        if self.manifest:
+            self.manifest.mark(name, "a", "failed", stage_hash=self.a_hash, error=err)
+
+    def b_done(self, name, st):
+        self.results.append(st)
+        self.n_done += 1
+        if self.manifest:
+            self.manifest.mark(name, "b", "done", stage_hash=self.b_hash, output_path=st["out_path"])
+
+    def b_failed(self, names, err):
+        for name in names:
+            print(f"[FAILED] B-pass {name}: {err}")
+            self.failed.append(name)
+            self.n_failed += 1
+            if self.manifest:
+                self.manifest.mark(name, "b", "failed", stage_hash=self.b_hash, error=err)
+
+    def collect(self, fut, group):
+        """Record one B-pass call; each image is marked on its own write. Returns the failed names."""
+        try:
+            stats = fut.result()
+        except Exception as e:
+            names = [ctx["name"] for _, ctx in group]
+            self.b_failed(names, e)
+            return names
+        failed = []
+        for (_, ctx), st in zip(group, stats):
+            try:
+                run_b_pass.wait_written([st])
+            except Exception as e:
+                self.b_failed([ctx["name"]], e)
+                failed.append(ctx["name"])
+                continue
+            self.b_done(ctx["name"], st)
+        return failed
+
+
+def job_name(wd):
+    return os.path.basename(os.path.normpath(wd))
+
+
+def run_pipelined(jobs, cfg, out_dir, dispatcher, log):
+    """A-pass for upcoming images runs in a process pool while B-pass requests are in flight.
+
+    jobs are (input, workdir, need_a); need_a False reuses A-pass artifacts already in workdir.
+    """
+    bc = cfg.get("batch") or {}
+    a_workers = max(1, int(bc.get("a_workers", 2)))
+    queue_size = max(1, int(bc.get("queue_size", a_workers * 2)))
+    batch_size = max(1, int(bc.get("img2img_batch_size", 2)))
+    linger_s = float(bc.get("linger_s", 0.5))
+    keep = True if log.manifest else None
+
+    todo = iter(jobs)
+    pending = deque()
+    in_flight = deque()
+    groups = {}
+
+    def flush(key):
+        group = groups.pop(key)
+        in_flight.append((submit_b(dispatcher, group), group))
+
+    def next_result_soon():
+        # The next queued image's A-pass is done (or not needed), or finishes within linger_s
+        fut = pending[0][1]
+        if fut is not None and not fut.done():
+            wait([fut], timeout=linger_s)
+        return fut is None or fut.done()
+
+    # Workers append to the same trace (also under the spawn start method)
+    with ProcessPoolExecutor(max_workers=a_workers, initializer=spans.configure, initargs=spans.settings()) as pool:
+        def fill():
+            while len(pending) < queue_size:
+                job = next(todo, None)
+                if job is None:
+                    return
+                img, wd, need_a = job
+                pending.append((job, pool.submit(run_a_pass.run, img, wd, cfg, keep) if need_a else None))
+
+        fill()
+        done = 0
+        while pending:
+            (img, wd, _), fut = pending.popleft()
+            name = job_name(wd)
+            fill()
+            done += 1
+            print(f"\n=== [{done}/{len(jobs)}] {img} ===")
+            try:
+                artifacts = fut.result() if fut else None
+                if fut:
+                    log.a_done(name)
+                prepared = run_b_pass.prepare(cfg, wd, out_dir, artifacts, dispatched=True)
+            except Exception as e:
+                if fut:
+                    log.a_failed(name, e)
+                else:
+                    log.b_failed([name], e)
+                continue
+
+            while len(in_flight) >= dispatcher.capacity + queue_size:
+                log.collect(*in_flight.popleft())
+
+            # Same-size images with identical settings share one img2img call
+            key = run_b_pass.batch_key(*prepared)
+            groups.setdefault(key, []).append(prepared)
+            if len(groups[key]) >= batch_size:
+                flush(key)
+            # Partial batches go out when nothing more is coming, or when the backends sit idle
+            # and no further A-pass result is ready within linger_s to fill them
+            if groups and (not pending or (all(f.done() for f, _ in in_flight) and not next_result_soon())):
+                for key in list(groups):
+                    flush(key)
+
+        for key in list(groups):
+            flush(key)
+        while in_flight:
+            log.collect(*in_flight.popleft())
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", default="config.yaml")
+    ap.add_argument("--engine", choices=("pipeline", "inprocess", "subprocess"), default="pipeline")
+    ap.add_argument("--force", action="store_true", help="ignore the manifest and reprocess every image")
+    ap.add_argument("--stats-json", help="write per-image B-pass stats and the run's wall time to this file")
+    ap.add_argument("--trace", help="append per-stage spans to this JSONL file (overrides trace.path)")
     args = ap.parse_args()
     cfg = load_cfg(args.config)
 
@@ -24,7 +201,7 @@ def main():
     os.makedirs(out_dir, exist_ok=True)
 
     imgs = []
-    for ext in ("*.png", "*.jpg", "*.jpeg", "*.webp"):
+    for ext in IMAGE_PATTERNS:
         imgs += glob.glob(os.path.join(input_dir, ext))
     imgs.sort()
     
@@ -32,16 +209,84 @@ def main():
         print(f"No images in {input_dir}")
         return
 
-    for i, img in enumerate(imgs, 1):
-        print(f"\n=== [{i}/{len(imgs)}] {img} ===")
+    manifest_path = (cfg.get("batch") or {}).get("manifest")
+    manifest = Manifest(manifest_path) if manifest_path and args.engine != "subprocess" else None
+    log = RunLog(cfg, manifest)
+
+    jobs = []
+    skipped = 0
+    for img in imgs:
         name = os.path.splitext(os.path.basename(img))[0]
         wd = os.path.join(work_dir, name)
-        os.makedirs(os.path.join(wd, "a_pass"), exist_ok=True)
-        os.makedirs(os.path.join(wd, "masks"), exist_ok=True)
+        need_a = True
+        if manifest and not args.force:
+            artifacts_exist = run_a_pass.artifacts_complete(wd)
+            plan = manifest.plan(name, img, log.a_hash, log.b_hash, writer.output_path(cfg, out_dir, name), artifacts_exist)
+            if plan == "skip":
+                skipped += 1
+                continue
+            need_a = plan == "ab"
+        elif manifest:
+            manifest.content_hash(name, img)
+        jobs.append((img, wd, need_a))
+
+    if manifest:
+        print(f"[MANIFEST] {len(imgs)} images: {skipped} up to date, {sum(1 for j in jobs if not j[2])} B-pass only, "
+              f"{sum(1 for j in jobs if j[2])} full")
+
+    tc = cfg.get("trace") or {}
+    trace_path = args.trace or tc.get("path")
+    if trace_path:
+        spans.configure(trace_path, run_id=f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}")
 
-        subprocess.run([sys.executable, "run_a_pass.py", "--config", args.config, "--input", img, "--workdir", wd], check=True)
-        subprocess.run([sys.executable, "run_b_pass.py", "--config", args.config, "--workdir", wd, "--output", out_dir], check=True)
+    t0 = time.perf_counter()
+    dispatcher = None
+    if args.engine == "pipeline":
+        with Dispatcher.from_cfg(cfg) as dispatcher:
+            run_pipelined(jobs, cfg, out_dir, dispatcher, log)
+    else:
+        dispatcher = Dispatcher.from_cfg(cfg) if args.engine == "inprocess" else None
+        for i, (img, wd, need_a) in enumerate(jobs, 1):
+            print(f"\n=== [{i}/{len(jobs)}] {img} ===")
+            if args.engine == "subprocess":
+                subprocess.run([sys.executable, "run_a_pass.py", "--config", args.config, "--input", img, "--workdir", wd], check=True)
+                subprocess.run([sys.executable, "run_b_pass.py", "--config", args.config, "--workdir", wd, "--output", out_dir], check=True)
+                continue
+            name = job_name(wd)
+            try:
+                artifacts = run_a_pass.run(img, wd, cfg, True if manifest else None) if need_a else None
+            except Exception as e:
+                log.a_failed(name, e)
+                continue
+            if need_a:
+                log.a_done(name)
+            try:
+                group = [run_b_pass.prepare(cfg, wd, out_dir, artifacts, dispatched=True)]
+            except Exception as e:
+                log.b_failed([name], e)
+                continue
+            log.collect(submit_b(dispatcher, group), group)
+        if dispatcher:
+            dispatcher.shutdown()
 
+    wall_s = time.perf_counter() - t0
+    print_summary(log.results, dispatcher)
+    if spans.enabled():
+        path, run_id = spans.settings()
+        spans.configure(None)
+        records = spans.load(path, run_id)
+        spans.print_summary(records)
+        if tc.get("prometheus"):
+            spans.write_prometheus(tc["prometheus"], records)
+    if args.stats_json:
+        with open(args.stats_json, "w", encoding="utf-8") as f:
+            json.dump({"engine": args.engine, "images": len(jobs), "skipped": skipped, "wall_s": wall_s,
+                       "failed": log.failed, "results": log.results}, f, indent=2)
+    if manifest:
+        manifest.close()
+    if log.failed:
+        print(f"\n{len(log.failed)} image(s) failed; rerun batch.py to retry them: {', '.join(log.failed)}")
+        sys.exit(1)
     print("\nAll done.")
 
 
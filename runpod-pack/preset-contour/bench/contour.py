@@ -0,0 +1,81 @@
+
+"""Microbenchmark: bbox-local contour rasterizer vs. the legacy full-frame path.
+
+    python bench/contour.py --sizes 1024,4096,8192
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from strokes import CONTOUR_STROKES, render_strokes  # noqa: E402
+
+
+def line_mask(w, h, points, width_rel=0.004, blur_rel=0.010):
+    m = Image.new("L", (w, h), 0)
+    draw = ImageDraw.Draw(m)
+    w_line = max(1, int(min(w, h) * width_rel))
+    draw.line(points, fill=255, width=w_line, joint="curve")
+    return m.filter(ImageFilter.GaussianBlur(radius=int(max(w, h) * blur_rel)))
+
+
+def ellipse_stroke_mask(w, h, cx, cy, rx, ry, width_rel=0.0035, blur_rel=0.010):
+    """Create a thin elliptical stroke by subtracting two ellipses."""
+    outer = Image.new("L", (w, h), 0)
+    inner = Image.new("L", (w, h), 0)
+    dw = max(1, int(min(w, h) * width_rel))
+    ImageDraw.Draw(outer).ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=255)
+    ImageDraw.Draw(inner).ellipse([cx - rx + dw, cy - ry + dw, cx + rx - dw, cy + ry - dw], fill=255)
+    stroke = ImageChops.subtract(outer, inner)
+    return stroke.filter(ImageFilter.GaussianBlur(radius=int(max(w, h) * blur_rel)))
+
+
+def render_reference(w, h, strokes=CONTOUR_STROKES):
+    """Legacy renderer: one full-frame mask and blur per stroke, folded with lighter()."""
+    out = Image.new("L", (w, h), 0)
+    for s in strokes:
+        if s.kind == "line":
+            pts = [(int(w * x), int(h * y)) for x, y in s.points]
+            m = line_mask(w, h, pts, width_rel=s.width_rel, blur_rel=s.blur_rel)
+        else:
+            (fx, fy), (frx, fry) = s.points
+            m = ellipse_stroke_mask(w, h, int(w * fx), int(h * fy), int(w * frx), int(h * fry), width_rel=s.width_rel, blur_rel=s.blur_rel)
+        out = ImageChops.lighter(out, m)
+    return out
+
+
+def best_of(fn, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1024,4096,8192")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--no-reference", action="store_true", help="only time the new renderer")
+    args = ap.parse_args()
+
+    print(f"{'size':>10} {'legacy s':>10} {'bbox s':>10} {'speedup':>8} {'max diff':>9}")
+    for side in (int(v) for v in args.sizes.split(",")):
+        t_new, new = best_of(lambda: render_strokes(side, side), args.repeat)
+        if args.no_reference:
+            print(f"{side:>5}x{side:<4} {'-':>10} {t_new:>10.3f} {'-':>8} {'-':>9}")
+            continue
+        t_ref, ref = best_of(lambda: render_reference(side, side), 1)
+        diff = int(np.abs(np.asarray(ref, dtype=np.int16) - np.asarray(new, dtype=np.int16)).max())
+        print(f"{side:>5}x{side:<4} {t_ref:>10.3f} {t_new:>10.3f} {t_ref / t_new:>7.1f}x {diff:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Stand-in for the A1111 API, for benchmarking the client side without a GPU.
+
+    python bench/mock_a1111.py --port 7861 --latency 2.5 --response-size request
+
+Answers /sdapi/v1/img2img after `latency` (+ uniform `jitter`) seconds with batch_size
+PNG images, either at the requested width/height or at a fixed --response-size.
+--noise makes the returned PNGs incompressible, closer in size to real generations.
+"""
+import io
+import json
+import time
+import random
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+
+class MockA1111(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=7861, latency=0.0, jitter=0.0, response_size=None, noise=False, host="127.0.0.1"):
+        super().__init__((host, port), Handler)
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.response_size = response_size
+        self.noise = noise
+        self.checkpoint = "mock.safetensors"
+        self.requests = []
+        self._lock = threading.Lock()
+        self._images = {}
+        self._busy_since = None
+
+    def image_b64(self, size):
+        # Encoded once per size so the mock's own CPU stays out of the measurement
+        with self._lock:
+            if size not in self._images:
+                if self.noise:
+                    px = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+                    im = Image.fromarray(px)
+                else:
+                    im = Image.new("RGB", size, (180, 140, 120))
+                buf = io.BytesIO()
+                im.save(buf, format="PNG", compress_level=1)
+                self._images[size] = base64.b64encode(buf.getvalue()).decode("ascii")
+            return self._images[size]
+
+    def record(self, nbytes, batch, started, finished):
+        with self._lock:
+            self.requests.append({"bytes": nbytes, "batch": batch, "started": started, "finished": finished})
+
+    def stats(self):
+        with self._lock:
+            return list(self.requests)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, obj, code=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        srv = self.server
+        if self.path.startswith("/sdapi/v1/sd-models"):
+            return self._send([{"title": srv.checkpoint, "model_name": srv.checkpoint}])
+        if self.path.startswith("/sdapi/v1/options"):
+            return self._send({"sd_model_checkpoint": srv.checkpoint})
+        if self.path.startswith("/sdapi/v1/progress"):
+            # Keeps moving while a job runs, so the client's stall watchdog stays quiet
+            since = srv._busy_since
+            return self._send({"progress": 0.0 if since is None else round(time.monotonic() - since, 2), "state": {"job": "mock"}})
+        self._send({"detail": "Not Found"}, 404)
+
+    def do_POST(self):
+        srv = self.server
+        raw = self._body()
+        if self.path.startswith("/sdapi/v1/options"):
+            srv.checkpoint = json.loads(raw or b"{}").get("sd_model_checkpoint", srv.checkpoint)
+            return self._send(None)
+        if self.path.startswith("/sdapi/v1/interrupt"):
+            return self._send({})
+        if not self.path.startswith("/sdapi/v1/img2img"):
+            return self._send({"detail": "Not Found"}, 404)
+
+        started = time.time()
+        payload = json.loads(raw)
+        n = int(payload.get("batch_size") or 1)
+        size = srv.response_size or (int(payload.get("width", 512)), int(payload.get("height", 512)))
+        srv._busy_since = time.monotonic()
+        time.sleep(srv.latency + random.uniform(0, srv.jitter))
+        srv._busy_since = None
+        self._send({"images": [srv.image_b64(size)] * n, "parameters": {}, "info": "{}"})
+        srv.record(len(raw), n, started, time.time())
+
+
+def start(port=7861, **kwargs):
+    """Serve in a daemon thread and return the server; call .shutdown() when done."""
+    srv = MockA1111(port, **kwargs)
+    threading.Thread(target=srv.serve_forever, name="mock-a1111", daemon=True).start()
+    return srv
+
+
+def parse_size(value):
+    if not value or value == "request":
+        return None
+    w, h = value.lower().split("x")
+    return int(w), int(h)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=7861)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--latency", type=float, default=2.0, help="seconds per img2img call")
+    ap.add_argument("--jitter", type=float, default=0.0, help="extra uniform random seconds")
+    ap.add_argument("--response-size", default="request", help='"request" (payload width x height) or WxH')
+    ap.add_argument("--noise", action="store_true", help="return incompressible images")
+    args = ap.parse_args()
+
+    srv = MockA1111(args.port, args.latency, args.jitter, parse_size(args.response_size), args.noise, host=args.host)
+    print(f"[MOCK] A1111 stand-in on http://{args.host}:{args.port} (latency {args.latency}s)")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
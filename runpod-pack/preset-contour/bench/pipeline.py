@@ -0,0 +1,272 @@
+"""End-to-end benchmark: A-pass stages and the batch.py flow against a mock A1111.
+
+    python bench/pipeline.py --sizes 768x1024,1600x2400,3000x4000 --images 8 --out bench.json
+    python bench/pipeline.py --baseline bench.json          # compare against an earlier run
+
+Synthetic portraits are generated per size. Each A-pass stage is timed per image, then
+batch.py runs on the same inputs against bench/mock_a1111.py. Results (images/sec,
+per-stage p50/p95, request bytes, peak RSS) are written as JSON.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+import yaml
+from PIL import Image, ImageDraw, ImageFilter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import decode  # noqa: E402
+import run_a_pass  # noqa: E402
+import run_b_pass  # noqa: E402
+import mock_a1111  # noqa: E402
+
+# Runs a command and reports the peak RSS of its largest process (batch.py or an A-pass worker)
+RSS_WRAPPER = (
+    "import resource, subprocess, sys\n"
+    "rc = subprocess.call(sys.argv[2:])\n"
+    "open(sys.argv[1], 'w').write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))\n"
+    "sys.exit(rc)\n"
+)
+
+
+def maxrss_mb(value):
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return value / (1024 * 1024) if sys.platform == "darwin" else value / 1024
+
+
+def synthetic_portrait(w, h, seed=0):
+    """Gradient background, skin-tone face oval with eyes/brows/lips, plus sensor-like noise."""
+    rng = np.random.default_rng(seed)
+    ys = np.linspace(0, 1, h, dtype=np.float32)[:, None, None]
+    bg = (np.array([70, 80, 95], np.float32) * (1 - ys) + np.array([30, 32, 40], np.float32) * ys)
+    im = Image.fromarray(np.broadcast_to(bg, (h, w, 3)).astype(np.uint8))
+    d = ImageDraw.Draw(im)
+    cx, cy = w * 0.5, h * 0.45
+    d.ellipse([cx - w * 0.36, cy + h * 0.18, cx + w * 0.36, h * 1.2], fill=(60, 60, 70))
+    d.ellipse([cx - w * 0.22, cy - h * 0.22, cx + w * 0.22, cy + h * 0.24], fill=(214, 170, 146))
+    for ex in (-0.09, 0.09):
+        d.ellipse([cx + w * (ex - 0.04), h * 0.40, cx + w * (ex + 0.04), h * 0.425], fill=(245, 240, 235))
+        d.ellipse([cx + w * (ex - 0.015), h * 0.40, cx + w * (ex + 0.015), h * 0.425], fill=(70, 45, 30))
+        d.line([cx + w * (ex - 0.05), h * 0.38, cx + w * (ex + 0.05), h * 0.375], fill=(80, 55, 40), width=max(2, w // 120))
+    d.ellipse([cx - w * 0.06, h * 0.57, cx + w * 0.06, h * 0.60], fill=(170, 70, 80))
+    im = im.filter(ImageFilter.GaussianBlur(max(1, w // 400)))
+    px = np.asarray(im, dtype=np.int16) + rng.normal(0, 6, (h, w, 1)).astype(np.int16)
+    return Image.fromarray(np.clip(px, 0, 255).astype(np.uint8))
+
+
+def make_inputs(input_dir, size, n):
+    os.makedirs(input_dir, exist_ok=True)
+    w, h = size
+    base = synthetic_portrait(w, h)
+    paths = []
+    for i in range(n):
+        # Slight per-image variation so inputs (and their hashes) differ
+        im = base if i == 0 else base.transpose(Image.FLIP_LEFT_RIGHT) if i % 2 else base.rotate(0.5 * i)
+        path = os.path.join(input_dir, f"bench_{w}x{h}_{i:03d}.jpg")
+        im.save(path, format="JPEG", quality=92)
+        paths.append(path)
+    return paths
+
+
+def summarize(samples):
+    a = np.asarray(samples, dtype=np.float64)
+    return {"n": int(a.size), "p50_s": float(np.percentile(a, 50)), "p95_s": float(np.percentile(a, 95)), "mean_s": float(a.mean())}
+
+
+def timed(samples, name, fn):
+    t = time.perf_counter()
+    out = fn()
+    samples.setdefault(name, []).append(time.perf_counter() - t)
+    return out
+
+
+def bench_stages(paths, cfg, tmp):
+    """Time each A-pass stage (geometry uncached) plus B-pass payload build and result save.
+
+    Stages call the run_a_pass functions run() is built from, so the numbers track the real code.
+    """
+    ac = cfg.get("a_pass") or {}
+    level = int(ac.get("png_compress_level", 1))
+    samples = {}
+    payload_bytes = []
+    for path in paths:
+        img, _ = timed(samples, "decode", lambda: run_a_pass.decode_input(path))
+        w, h = img.size
+        timed(samples, "decode_reduced", lambda: run_a_pass.decode_input(path, decode.generation_size(w, h)))
+        box = run_a_pass.work_box(w, h, ac)
+        face = timed(samples, "face_mask", lambda: run_a_pass.tight_face_mask((w, h), box))
+        contour = timed(samples, "contour_map", lambda: run_a_pass.contour_map(w, h, face, box))
+        geo = {"face": face, "contour": contour}
+        timed(samples, "geometry_png", lambda: run_a_pass.encode_geometry(geo, w, h, box, level))
+
+        timed(samples, "unsharp", lambda: run_a_pass.enhance(img, box, face))
+        timed(samples, "base_png", lambda: run_a_pass.encode_png(img, level))
+
+        # Whole A-pass as batch.py runs it (geometry from the mask cache after the first image)
+        artifacts = timed(samples, "a_pass_run", lambda: run_a_pass.run(path, os.path.join(tmp, "work"), cfg, False))
+        payload, ctx = timed(samples, "b_payload", lambda: run_b_pass.build_payload(cfg, artifacts))
+        body = timed(samples, "b_json", lambda: json.dumps(payload).encode("utf-8"))
+        payload_bytes.append(len(body))
+
+        buf = Image.new("RGB", (payload["width"], payload["height"]), (180, 140, 120))
+        png = run_a_pass.encode_png(buf, level)
+        fake = base64.b64encode(png).decode("ascii")
+        timed(samples, "b_save", lambda: run_b_pass.save_result(fake, ctx, os.path.join(tmp, "result.png")).result())
+
+    out = {name: summarize(v) for name, v in samples.items()}
+    out["request_bytes_per_image"] = float(np.mean(payload_bytes))
+    return out
+
+
+def bench_batch(paths, cfg, tmp, port, engine, mock):
+    """Run batch.py on `paths` against the mock server; returns throughput, latency, bytes and RSS."""
+    input_dir = os.path.dirname(paths[0])
+    run_cfg = json.loads(json.dumps(cfg))
+    run_cfg["general"]["a1111_endpoint"] = f"http://127.0.0.1:{port}"
+    run_cfg["general"]["a1111_endpoints"] = []
+    run_cfg["io"] = {"input_dir": input_dir, "work_dir": os.path.join(tmp, "work"), "output_dir": os.path.join(tmp, "output")}
+    run_cfg.setdefault("batch", {})["manifest"] = ""
+    cfg_path = os.path.join(tmp, "config.yaml")
+    with open(cfg_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(run_cfg, f)
+
+    stats_path = os.path.join(tmp, "stats.json")
+    rss_path = os.path.join(tmp, "rss.txt")
+    before = len(mock.stats())
+    cmd = [sys.executable, "-c", RSS_WRAPPER, rss_path, sys.executable, "batch.py", "--config", cfg_path, "--engine", engine, "--stats-json", stats_path]
+    t = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - t
+    if proc.returncode != 0 or not os.path.exists(stats_path):
+        raise RuntimeError(f"batch.py failed ({proc.returncode}): {proc.stderr[-2000:]}")
+
+    with open(stats_path, encoding="utf-8") as f:
+        stats = json.load(f)
+    with open(rss_path) as f:
+        peak = maxrss_mb(int(f.read()))
+    reqs = mock.stats()[before:]
+    rtt = [r["rtt_s"] for r in stats["results"]]
+    sent = [r["bytes"] for r in reqs]
+    return {
+        "images": stats["images"],
+        "failed": len(stats["failed"]),
+        "wall_s": stats["wall_s"],
+        "process_wall_s": wall,
+        "images_per_s": stats["images"] / stats["wall_s"] if stats["wall_s"] else None,
+        "img2img_calls": len(reqs),
+        "request_bytes_total": int(sum(sent)),
+        "request_bytes_per_image": sum(sent) / max(1, stats["images"]),
+        "b_round_trip": summarize(rtt) if rtt else None,
+        "peak_rss_mb": peak,
+    }
+
+
+def compare(current, baseline, threshold=0.10):
+    """Print stage-by-stage p50 and throughput against a previous result file."""
+    print(f"\n{'size':>10} {'metric':>24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for size, stages in current.get("a_pass", {}).items():
+        old = baseline.get("a_pass", {}).get(size, {})
+        for name, st in stages.items():
+            if isinstance(st, dict) and isinstance(old.get(name), dict):
+                _row(size, f"{name} p50 s", old[name]["p50_s"], st["p50_s"], threshold)
+    for size, run in current.get("batch", {}).items():
+        old = baseline.get("batch", {}).get(size)
+        if old:
+            _row(size, "images/s", old["images_per_s"], run["images_per_s"], threshold, higher_is_better=True)
+            _row(size, "request bytes/image", old["request_bytes_per_image"], run["request_bytes_per_image"], threshold)
+            _row(size, "peak RSS MB", old["peak_rss_mb"], run["peak_rss_mb"], threshold)
+
+
+def _row(size, metric, old, new, threshold, higher_is_better=False):
+    if not old or new is None:
+        return
+    change = new / old - 1
+    worse = -change if higher_is_better else change
+    flag = "  <-- regression" if worse > threshold else ""
+    print(f"{size:>10} {metric:>24} {old:>10.4g} {new:>10.4g} {change:>+7.0%}{flag}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", default=os.path.join(ROOT, "config.yaml"))
+    ap.add_argument("--sizes", default="768x1024,1600x2400,3000x4000")
+    ap.add_argument("--images", type=int, default=8, help="images per size")
+    ap.add_argument("--engine", choices=("pipeline", "inprocess"), default="pipeline")
+    ap.add_argument("--port", type=int, default=7899)
+    ap.add_argument("--latency", type=float, default=0.5, help="mock img2img seconds per call")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--response-size", default="request", help='mock response: "request" or WxH')
+    ap.add_argument("--noise", action="store_true", help="mock returns incompressible images")
+    ap.add_argument("--no-batch", action="store_true", help="only time the A-pass/B-pass stages")
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--baseline", help="earlier result file to compare against")
+    args = ap.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f)
+    sizes = [tuple(int(v) for v in s.lower().split("x")) for s in args.sizes.split(",")]
+    baseline = None
+    if args.baseline:
+        # Read first: --baseline may name the file this run overwrites
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    mock = None
+    if not args.no_batch:
+        mock = mock_a1111.start(args.port, latency=args.latency, jitter=args.jitter,
+                                response_size=mock_a1111.parse_size(args.response_size), noise=args.noise)
+
+    result = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "params": {"sizes": args.sizes, "images": args.images, "engine": args.engine, "latency": args.latency,
+                   "jitter": args.jitter, "response_size": args.response_size, "noise": args.noise,
+                   "a_pass": cfg.get("a_pass"), "batch": cfg.get("batch")},
+        "a_pass": {},
+        "batch": {},
+    }
+    try:
+        for w, h in sizes:
+            label = f"{w}x{h}"
+            with tempfile.TemporaryDirectory(prefix=f"bench_{label}_") as tmp:
+                paths = make_inputs(os.path.join(tmp, "input"), (w, h), args.images)
+                result["a_pass"][label] = bench_stages(paths, cfg, tmp)
+                st = result["a_pass"][label]
+                print(f"[BENCH] {label} A-pass p50 {st['a_pass_run']['p50_s']:.3f}s p95 {st['a_pass_run']['p95_s']:.3f}s, "
+                      f"request {st['request_bytes_per_image'] / 1e6:.2f} MB/image")
+                if mock:
+                    run = bench_batch(paths, cfg, tmp, args.port, args.engine, mock)
+                    result["batch"][label] = run
+                    print(f"[BENCH] {label} batch {run['images']} images in {run['wall_s']:.2f}s ({run['images_per_s']:.2f} img/s), "
+                          f"{run['img2img_calls']} img2img calls, peak RSS {run['peak_rss_mb']:.0f} MB")
+    finally:
+        if mock:
+            mock.shutdown()
+
+    result["meta"]["bench_peak_rss_mb"] = maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"[BENCH] Results -> {args.out}")
+
+    if baseline:
+        compare(result, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+
+import io
+import struct
+
+from PIL import Image
+
+# Longest side the B-pass renders at
+MAX_SIDE = 768
+
+
+def generation_size(w, h, max_side=MAX_SIDE):
+    """Render size for a w x h source: longest side <= max_side, both sides multiples of 64 (>= 256)."""
+    def to_multiple_of_64(value):
+        return max(256, (int(value) // 64) * 64)
+
+    scale = min(1.0, float(max_side) / float(max(w, h) or 1))
+    return to_multiple_of_64(w * scale), to_multiple_of_64(h * scale)
+
+
+def _fp(src):
+    return io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src
+
+
+def probe_size(src):
+    """(w, h) from the file header; no pixels are decoded."""
+    with Image.open(_fp(src)) as im:
+        return im.size
+
+
+def png_size(data):
+    """(w, h) of PNG bytes from the IHDR chunk, or None for anything else."""
+    if data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+
+def open_rgb(src, min_size=None):
+    """Decode a path or bytes to RGB.
+
+    With min_size, JPEGs are decoded by libjpeg at 1/2, 1/4 or 1/8 scale (in the DCT, so the
+    skipped pixels are never produced) as long as both sides stay >= min_size. Other formats,
+    and JPEGs too small to reduce, decode at full size.
+    """
+    im = Image.open(_fp(src))
+    if min_size and im.format == "JPEG":
+        im.draft("RGB", tuple(min_size))
+    return im.convert("RGB")
@@ -0,0 +1,250 @@
+
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+
+import spans
+from a1111_client import A1111Client, BackendError
+
+
+class Backend:
+    def __init__(self, url, max_inflight=1, client=None):
+        self.url = url.rstrip("/")
+        self.max_inflight = max(1, int(max_inflight))
+        self.inflight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.client = client or A1111Client(self.url, pool_size=self.max_inflight * 2)
+        self.session = self.client.session
+        # (checkpoint, controlnet models) of the jobs this backend is currently set up for;
+        # set only once a switch has finished
+        self.affinity = None
+        self.checkpoint = None
+        # True while a job is switching the checkpoint; nothing else is dispatched here meanwhile
+        self.switching = False
+
+    def healthy(self, now):
+        return now >= self.down_until
+
+    def load(self):
+        return self.inflight / self.max_inflight
+
+    def __repr__(self):
+        return f"Backend({self.url}, {self.inflight}/{self.max_inflight})"
+
+
+def backends_from_cfg(cfg):
+    g = cfg["general"]
+    eps = g.get("a1111_endpoints") or [g["a1111_endpoint"]]
+    out = []
+    for ep in eps:
+        if isinstance(ep, str):
+            ep = {"url": ep}
+        max_inflight = max(1, int(ep.get("max_inflight", 1)))
+        cc = dict(cfg.get("client") or {})
+        cc.setdefault("pool_size", max_inflight * 2)
+        out.append(Backend(ep["url"], max_inflight, client=A1111Client(ep["url"], **cc)))
+    return out
+
+
+def same_checkpoint(a, b):
+    # A1111 reports titles like "sub/model.safetensors [abcd1234]"; config usually holds the file name
+    norm = lambda v: os.path.basename((v or "").split(" [")[0])
+    return norm(a) == norm(b)
+
+
+def set_checkpoint(backend, name, timeout=900):
+    """Load `name` on the backend once via /sdapi/v1/options. Returns True if a switch happened."""
+    if backend.checkpoint is None:
+        r = backend.client.get("/sdapi/v1/options")
+        if r.status_code == 200:
+            backend.checkpoint = (r.json() or {}).get("sd_model_checkpoint")
+    if same_checkpoint(backend.checkpoint, name):
+        return False
+    r = backend.client.post("/sdapi/v1/options", json={"sd_model_checkpoint": name}, timeout=(backend.client.connect_timeout_s, timeout))
+    if r.status_code != 200:
+        raise BackendError(f"checkpoint switch to {name} failed HTTP {r.status_code}: {r.text[:500]}")
+    backend.checkpoint = name
+    return True
+
+
+class _Task:
+    def __init__(self, job, affinity):
+        self.job = job
+        self.affinity = affinity
+        self.future = Future()
+        self.tried = set()
+        self.attempt = 0
+
+
+class Dispatcher:
+    """Runs B-pass jobs on the least-loaded healthy A1111 backend.
+
+    A job is a callable taking the chosen Backend. Backends are probed for readiness before
+    their first job. When a job raises BackendError or a requests error the backend is
+    benched for `cooldown` seconds and the job is requeued on another backend, up to
+    `max_attempts` times.
+
+    Jobs may carry an affinity of (checkpoint, controlnet models). Queued jobs go to a
+    backend already set up for their affinity first; an idle backend is switched (checkpoint
+    loaded once via /sdapi/v1/options) only when no queued job matches it, so switches
+    happen between groups rather than around every request. A backend takes no other job
+    while it switches, and only counts as set up for the new affinity once the switch is done.
+    """
+
+    def __init__(self, backends, max_attempts=None, cooldown=30.0):
+        if not backends:
+            raise ValueError("no A1111 backends configured")
+        self.backends = backends
+        self.capacity = sum(b.max_inflight for b in backends)
+        self.max_attempts = max_attempts or len(backends) + 1
+        self.cooldown = float(cooldown)
+        self.switches = 0
+        self.switch_time_s = 0.0
+        self.cn_switches = 0
+        self._queue = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._worker, name=f"b-pass-{i}", daemon=True) for i in range(self.capacity)]
+        for t in self._threads:
+            t.start()
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        bc = cfg.get("batch") or {}
+        return cls(backends_from_cfg(cfg), max_attempts=bc.get("max_attempts"), cooldown=bc.get("backend_cooldown_s", 30.0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _pick(self, now):
+        free = [b for b in self.backends if b.inflight < b.max_inflight and b.healthy(now) and not b.switching]
+        if not free:
+            return None
+
+        def usable(task):
+            # Prefer backends this job has not failed on yet
+            cands = [b for b in free if b not in task.tried]
+            if not cands and all(b in task.tried or not b.healthy(now) for b in self.backends):
+                cands = free
+            return cands
+
+        # 1) A queued job that fits a backend already set up for it
+        for task in self._queue:
+            cands = [b for b in usable(task) if task.affinity is None or b.affinity == task.affinity]
+            if cands:
+                return task, min(cands, key=lambda x: (x.load(), x.inflight))
+
+        # 2) Otherwise switch an idle backend, preferring one no queued job is waiting for
+        wanted = {t.affinity for t in self._queue}
+        for task in self._queue:
+            cands = [b for b in usable(task) if b.inflight == 0]
+            if cands:
+                return task, min(cands, key=lambda x: (x.affinity in wanted, x.failures))
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    picked = self._pick(now) if self._queue else None
+                    if picked:
+                        task, backend = picked
+                        self._queue.remove(task)
+                        backend.inflight += 1
+                        prev = backend.affinity
+                        if task.affinity is not None and task.affinity != prev:
+                            backend.switching = True
+                        break
+                    if self._closed and not self._queue:
+                        return
+                    wake = [b.down_until - now for b in self.backends if not b.healthy(now)]
+                    self._cond.wait(timeout=min(wake) if wake else None)
+            self._execute(task, backend, prev)
+
+    def _switch(self, backend, prev, affinity):
+        checkpoint, cn_models = affinity
+        if checkpoint:
+            t0 = time.perf_counter()
+            with spans.span("b.checkpoint", backend=backend.url, checkpoint=checkpoint) as sp:
+                sp["switched"] = switched = set_checkpoint(backend, checkpoint)
+            if switched:
+                dt = time.perf_counter() - t0
+                with self._cond:
+                    self.switches += 1
+                    self.switch_time_s += dt
+                print(f"[DISPATCH] {backend.url} switched checkpoint to {checkpoint} in {dt:.1f}s")
+        if prev is not None and prev[1] != cn_models:
+            with self._cond:
+                self.cn_switches += 1
+
+    def _execute(self, task, backend, prev):
+        task.attempt += 1
+        try:
+            backend.client.ensure_ready()
+            if backend.switching:
+                self._switch(backend, prev, task.affinity)
+                with self._cond:
+                    backend.affinity = task.affinity
+                    backend.switching = False
+                    self._cond.notify_all()
+            result = task.job(backend)
+        except (BackendError, requests.RequestException) as e:
+            with self._cond:
+                backend.inflight -= 1
+                backend.failures += 1
+                backend.down_until = time.monotonic() + self.cooldown
+                # Its model state is unknown after a failure; probe readiness again before reuse
+                backend.affinity = backend.checkpoint = None
+                backend.switching = False
+                backend.client.ready = False
+                task.tried.add(backend)
+                if task.attempt < self.max_attempts:
+                    print(f"[DISPATCH] {backend.url} failed ({e}); requeueing (attempt {task.attempt + 1}/{self.max_attempts})")
+                    self._queue.insert(0, task)
+                    self._cond.notify_all()
+                    return
+                self._cond.notify_all()
+            task.future.set_exception(e)
+            return
+        except BaseException as e:
+            with self._cond:
+                if backend.switching:
+                    backend.affinity = backend.checkpoint = None
+                    backend.switching = False
+            self._release(backend)
+            task.future.set_exception(e)
+            return
+        with self._cond:
+            backend.failures = 0
+        self._release(backend)
+        task.future.set_result(result)
+
+    def _release(self, backend):
+        with self._cond:
+            backend.inflight -= 1
+            self._cond.notify_all()
+
+    def submit(self, job, affinity=None):
+        task = _Task(job, affinity)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("dispatcher is shut down")
+            self._queue.append(task)
+            self._cond.notify_all()
+        return task.future
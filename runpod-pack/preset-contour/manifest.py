@@ -0,0 +1,130 @@
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+from run_a_pass import CONTOUR_STROKES, GEOMETRY_VERSION
+
+# a_pass knobs that change how the stage runs but not what it produces
+A_PASS_RUNTIME_KEYS = ("mask_cache_size", "mask_cache_dir", "keep_intermediates", "png_compress_level")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    input_path TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    content_hash TEXT,
+    a_hash TEXT,
+    a_status TEXT,
+    b_hash TEXT,
+    b_status TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    output_path TEXT,
+    updated_at REAL
+)
+"""
+
+
+def config_hash(section, exclude=(), extra=None):
+    data = {k: v for k, v in (section or {}).items() if k not in exclude}
+    if extra is not None:
+        data["_extra"] = extra
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def stage_hashes(cfg):
+    """(a_hash, b_hash) of the effective config each stage's output depends on."""
+    a_hash = config_hash(cfg.get("a_pass"), exclude=A_PASS_RUNTIME_KEYS, extra={"geometry": GEOMETRY_VERSION, "strokes": CONTOUR_STROKES})
+    b_hash = config_hash(cfg.get("b_pass"), extra={"model_checkpoint": cfg["general"].get("model_checkpoint")})
+    return a_hash, b_hash
+
+
+def file_hash(path, chunk=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """SQLite record of every input: content hash, per-stage config hash and status.
+
+    plan() decides what a rerun has to do for an image:
+      "skip" - output is up to date
+      "b"    - A-pass artifacts in the work dir are still valid, only the B-pass reruns
+      "ab"   - run both passes
+    Failures are recorded (status "failed") and retried on the next run.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _row(self, name):
+        return self.db.execute("SELECT * FROM images WHERE name = ?", (name,)).fetchone()
+
+    def content_hash(self, name, input_path):
+        # Rehash only when size or mtime changed since the last run
+        st = os.stat(input_path)
+        row = self._row(name)
+        if row and row["input_path"] == input_path and row["size"] == st.st_size and row["mtime_ns"] == st.st_mtime_ns and row["content_hash"]:
+            return row["content_hash"]
+        digest = file_hash(input_path)
+        self.db.execute(
+            "INSERT INTO images (name, input_path, size, mtime_ns, content_hash, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET input_path = excluded.input_path, size = excluded.size, mtime_ns = excluded.mtime_ns, "
+            # New content invalidates both stages
+            "a_status = CASE WHEN images.content_hash = excluded.content_hash THEN images.a_status END, "
+            "b_status = CASE WHEN images.content_hash = excluded.content_hash THEN images.b_status END, "
+            "content_hash = excluded.content_hash, updated_at = excluded.updated_at",
+            (name, input_path, st.st_size, st.st_mtime_ns, digest, time.time()),
+        )
+        self.db.commit()
+        return digest
+
+    def plan(self, name, input_path, a_hash, b_hash, out_path, artifacts_exist):
+        self.content_hash(name, input_path)
+        row = self._row(name)
+        a_ok = row["a_hash"] == a_hash and row["a_status"] == "done"
+        if a_ok and row["b_hash"] == b_hash and row["b_status"] == "done" and os.path.exists(out_path):
+            return "skip"
+        if a_ok and artifacts_exist:
+            return "b"
+        return "ab"
+
+    def mark(self, name, stage, status, stage_hash=None, error=None, output_path=None):
+        assert stage in ("a", "b")
+        sets = [f"{stage}_status = ?", "updated_at = ?"]
+        args = [status, time.time()]
+        if stage_hash is not None:
+            sets.append(f"{stage}_hash = ?")
+            args.append(stage_hash)
+        if status == "failed":
+            sets += ["attempts = attempts + 1", "error = ?"]
+            args.append(str(error)[:2000])
+        elif status == "done":
+            sets.append("error = NULL")
+        if stage == "a":
+            # A B-pass result built on a previous A-pass is no longer valid
+            sets.append("b_status = NULL")
+        if output_path is not None:
+            sets.append("output_path = ?")
+            args.append(output_path)
+        self.db.execute(f"UPDATE images SET {', '.join(sets)} WHERE name = ?", (*args, name))
+        self.db.commit()
+
+    def counts(self):
+        rows = self.db.execute("SELECT a_status, b_status, COUNT(*) AS n FROM images GROUP BY a_status, b_status").fetchall()
+        return {(r["a_status"], r["b_status"]): r["n"] for r in rows}
@@ -0,0 +1,92 @@
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class MaskCache:
+    """LRU of geometry-only masks keyed by resolution, with an optional PNG store on disk.
+
+    Entries are dicts of name -> PIL "L" image. Cached images are shared between
+    callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_items=4, disk_dir=None):
+        self.max_items = max(0, int(max_items))
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = {}  # key -> Lock, so concurrent callers build an entry once
+
+    def _load_disk(self, key):
+        d = os.path.join(self.disk_dir, key)
+        if not os.path.isdir(d):
+            return None
+        entry = {}
+        for fn in sorted(os.listdir(d)):
+            if not fn.endswith(".png"):
+                continue
+            with Image.open(os.path.join(d, fn)) as im:
+                entry[fn[:-4]] = im.convert("L")
+        return entry or None
+
+    def _save_disk(self, key, entry):
+        # Write into a private dir and rename it into place so readers never see a partial entry
+        d = os.path.join(self.disk_dir, key)
+        tmp = f"{d}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for name, im in entry.items():
+            im.save(os.path.join(tmp, f"{name}.png"), format="PNG")
+        try:
+            os.rename(tmp, d)
+        except OSError:
+            # Another worker stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _remember(self, key, entry):
+        if not self.max_items:
+            return
+        with self._lock:
+            self._mem[key] = entry
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def get(self, key, build):
+        entry = self._cached(key)
+        if entry is not None:
+            return entry
+        with self._lock:
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            entry = self._cached(key)
+            if entry is None:
+                entry = self._get_slow(key, build)
+        with self._lock:
+            self._building.pop(key, None)
+        return entry
+
+    def _get_slow(self, key, build):
+        entry = self._load_disk(key) if self.disk_dir else None
+        if entry is None:
+            self.misses += 1
+            entry = build()
+            if self.disk_dir:
+                self._save_disk(key, entry)
+        else:
+            self.hits += 1
+        self._remember(key, entry)
+        return entry
@@ -1,26 +1,75 @@
 
 import os
+import io
+import json
+import hashlib
 import argparse
-from PIL import Image, ImageDraw, ImageFilter, ImageChops, ImageOps
+from functools import lru_cache
 
+import yaml
+from PIL import Image, ImageDraw, ImageFilter, ImageChops
 
-def tight_face_mask(img):
-    w, h = img.size
-    m = Image.new("L", (w, h), 0)
+import spans
+from decode import generation_size, open_rgb, probe_size
+from mask_cache import MaskCache
+from strokes import CONTOUR_STROKES, render_strokes
+
+# Bump whenever tight_face_mask geometry changes; contour strokes are hashed directly.
+GEOMETRY_VERSION = 1
+
+# Where each A-pass artifact lives under a work dir (read back by run_b_pass)
+ARTIFACT_PATHS = {
+    "base": os.path.join("a_pass", "base_enhanced.png"),
+    "face": os.path.join("masks", "face_mask.png"),
+    "contour": os.path.join("a_pass", "contour_map.png"),
+}
+# Written next to them in reduced decode mode: where the input the B-pass recomposites from
+# lives (path, sha256, size, mtime) plus its frame size and face box
+SOURCE_META = os.path.join("a_pass", "source.json")
+
+_mask_cache = None
+
+
+def geometry_key(w, h, box=None):
+    params = {"version": GEOMETRY_VERSION, "size": [w, h], "box": list(box or (0, 0, w, h)), "strokes": CONTOUR_STROKES}
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return f"{w}x{h}-{digest}"
+
+
+def face_key(w, h, box=None):
+    """Mask cache key for the face mask alone (no contour map), as the B-pass recomposite needs it."""
+    return f"{geometry_key(w, h, box)}-face"
+
+
+def face_roi(w, h):
+    """Box (x0, y0, x1, y1) outside which the face mask, and so every A-pass edit, is exactly zero."""
+    cx, rx = int(w * 0.50), int(w * 0.22)
+    cy, ry = int(h * 0.48), int(h * 0.28)
+    # Same reach as the Gaussian in tight_face_mask (three box passes)
+    pad = 3 * (int(max(w, h) * 0.012) + 1) + 2
+    return (max(0, cx - rx - pad), max(0, max(cy - ry, int(h * 0.18)) - pad),
+            min(w, cx + rx + pad + 1), min(h, min(cy + ry, int(h * 0.65)) + pad + 1))
+
+
+def tight_face_mask(size, box=None):
+    w, h = size
+    ox, oy, x1, y1 = box or (0, 0, w, h)
+    m = Image.new("L", (x1 - ox, y1 - oy), 0)
     d = ImageDraw.Draw(m)
-    cx, cy = int(w * 0.50), int(h * 0.48)
+    cx, cy = int(w * 0.50) - ox, int(h * 0.48) - oy
     rx, ry = int(w * 0.22), int(h * 0.28)
     d.ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=255)
     
     # Remove eyes/mouth/top/neck
     eye_rx, eye_ry = int(w * 0.088), int(h * 0.046)
-    for ex in (int(w * 0.34), int(w * 0.66)):
-        ImageDraw.Draw(m).ellipse([ex - eye_rx, int(h * 0.41) - eye_ry, ex + eye_rx, int(h * 0.41) + eye_ry], fill=0)
+    eye_y = int(h * 0.41) - oy
+    for ex in (int(w * 0.34) - ox, int(w * 0.66) - ox):
+        d.ellipse([ex - eye_rx, eye_y - eye_ry, ex + eye_rx, eye_y + eye_ry], fill=0)
     
-    ImageDraw.Draw(m).ellipse([int(w * 0.50) - int(w * 0.15), int(h * 0.62) - int(h * 0.050),
-                               int(w * 0.50) + int(w * 0.15), int(h * 0.62) + int(h * 0.050)], fill=0)
-    ImageDraw.Draw(m).rectangle([0, 0, w, int(h * 0.18)], fill=0)
-    ImageDraw.Draw(m).rectangle([0, int(h * 0.65), w, h], fill=0)
+    mx, my = int(w * 0.50) - ox, int(h * 0.62) - oy
+    d.ellipse([mx - int(w * 0.15), my - int(h * 0.050), mx + int(w * 0.15), my + int(h * 0.050)], fill=0)
+    d.rectangle([-ox, -oy, w - ox, int(h * 0.18) - oy], fill=0)
+    d.rectangle([-ox, int(h * 0.65) - oy, w - ox, h - oy], fill=0)
     
     m = m.filter(ImageFilter.GaussianBlur(radius=int(max(w, h) * 0.012)))
     
@@ -33,138 +82,257 @@ def tight_face_mask(img):
     return m
 
 
-def line_mask(w, h, points, width_rel=0.004, blur_rel=0.010):
-    m = Image.new("L", (w, h), 0)
-    draw = ImageDraw.Draw(m)
-    w_line = max(1, int(min(w, h) * width_rel))
-    draw.line(points, fill=255, width=w_line, joint="curve")
-    return m.filter(ImageFilter.GaussianBlur(radius=int(max(w, h) * blur_rel)))
+def contour_map(w, h, face, box=None):
+    """Contour map for ControlNet2: dark strokes on white, confined to the face mask."""
+    lines = ImageChops.multiply(render_strokes(w, h, CONTOUR_STROKES, box=box), face)
+    return Image.composite(Image.new("L", face.size, 0), Image.new("L", face.size, 255), lines)
 
 
-def ellipse_stroke_mask(w, h, cx, cy, rx, ry, width_rel=0.0035, blur_rel=0.010):
-    """Create a thin elliptical stroke by subtracting two ellipses."""
-    outer = Image.new("L", (w, h), 0)
-    inner = Image.new("L", (w, h), 0)
-    dw = max(1, int(min(w, h) * width_rel))
-    ImageDraw.Draw(outer).ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=255)
-    ImageDraw.Draw(inner).ellipse([cx - rx + dw, cy - ry + dw, cx + rx - dw, cy + ry - dw], fill=255)
-    stroke = ImageChops.subtract(outer, inner)
-    return stroke.filter(ImageFilter.GaussianBlur(radius=int(max(w, h) * blur_rel)))
+def face_geometry(w, h, box=None):
+    """Face mask and contour map over `box`; both depend only on the frame size."""
+    with spans.span("a.face_mask", size=f"{w}x{h}"):
+        face = tight_face_mask((w, h), box)
+    with spans.span("a.contour_map", size=f"{w}x{h}"):
+        contour = contour_map(w, h, face, box)
+    return {"face": face, "contour": contour}
 
 
-def ellipse_mask(w, h, cx, cy, rx, ry, blur_rel):
-    m = Image.new("L", (w, h), 0)
-    ImageDraw.Draw(m).ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=255)
-    return m.filter(ImageFilter.GaussianBlur(radius=int(max(w, h) * blur_rel)))
+def work_box(w, h, ac):
+    """Face box when a_pass.roi is on (all mask and sharpening work stays inside it), else the frame."""
+    return face_roi(w, h) if ac.get("roi", True) else (0, 0, w, h)
 
 
-def union(*masks):
-    out = Image.new("L", masks[0].size, 0)
-    for mm in masks:
-        out = ImageChops.lighter(out, mm)
-    return out
+def expand_box(box, pad, w, h):
+    x0, y0, x1, y1 = box
+    return (max(0, x0 - pad), max(0, y0 - pad), min(w, x1 + pad), min(h, y1 + pad))
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--config", default="config.yaml")
-    ap.add_argument("--input", required=True)
-    ap.add_argument("--workdir", default="work")
-    args = ap.parse_args()
+def paste_full(roi, box, size, fill):
+    """Place an ROI-sized "L" image into a full frame filled with `fill`."""
+    if roi.size == size:
+        return roi
+    full = Image.new("L", size, fill)
+    full.paste(roi, box[:2])
+    return full
+
+
+def get_mask_cache(cfg=None):
+    global _mask_cache
+    if _mask_cache is None:
+        ac = (cfg or {}).get("a_pass") or {}
+        _mask_cache = MaskCache(max_items=int(ac.get("mask_cache_size", 4)), disk_dir=ac.get("mask_cache_dir") or None)
+    return _mask_cache
+
+
+def encode_png(im, level=1):
+    buf = io.BytesIO()
+    im.save(buf, format="PNG", compress_level=level)
+    return buf.getvalue()
+
 
-    os.makedirs(os.path.join(args.workdir, "a_pass"), exist_ok=True)
-    os.makedirs(os.path.join(args.workdir, "masks"), exist_ok=True)
+@lru_cache(maxsize=8)
+def geometry_png(key, w, h, box, level):
+    """Full-frame face mask and contour map PNG bytes, encoded once per geometry."""
+    geo = get_mask_cache().get(key, lambda: face_geometry(w, h, box))
+    with spans.span("a.geometry_png", size=f"{w}x{h}") as sp:
+        pngs = encode_geometry(geo, w, h, box, level)
+        sp["bytes_out"] = len(pngs[0]) + len(pngs[1])
+    return pngs
 
-    img = Image.open(args.input).convert("RGB")
+
+def encode_geometry(geo, w, h, box, level=1):
+    """(face PNG, contour PNG) bytes at full frame for ROI geometry from face_geometry()."""
+    return encode_png(paste_full(geo["face"], box, (w, h), 0), level), encode_png(paste_full(geo["contour"], box, (w, h), 255), level)
+
+
+def artifacts_complete(workdir):
+    """True when every artifact a B-pass-only rerun of `workdir` needs is on disk.
+
+    In reduced decode mode that includes the input itself, unchanged since the A-pass.
+    """
+    if not all(os.path.exists(os.path.join(workdir, rel)) for rel in ARTIFACT_PATHS.values()):
+        return False
+    meta = source_meta(workdir)
+    return meta is None or source_unchanged(meta)
+
+
+def source_meta(workdir):
+    """Contents of SOURCE_META, or None when `workdir` was not written in reduced decode mode."""
+    path = os.path.join(workdir, SOURCE_META)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def source_unchanged(meta):
+    """True if the input recorded in `meta` still exists with the same content.
+    Rehashes only when size or mtime changed."""
+    try:
+        st = os.stat(meta["input"])
+    except OSError:
+        return False
+    if (st.st_size, st.st_mtime_ns) == (meta.get("bytes"), meta.get("mtime_ns")):
+        return True
+    h = hashlib.sha256()
+    with open(meta["input"], "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest() == meta.get("sha256")
+
+
+def read_source(meta):
+    """The input's bytes for a reduced-decode B-pass; FileNotFoundError if it is gone or changed."""
+    try:
+        with open(meta["input"], "rb") as f:
+            data = f.read()
+    except OSError:
+        data = None
+    if data is None or hashlib.sha256(data).hexdigest() != meta.get("sha256"):
+        raise FileNotFoundError(f"{meta['input']} is missing or changed since its A-pass; rerun the A-pass")
+    return data
+
+
+def enhance(img, box, face):
+    """Unsharp the face area of `img` in place, blended in by the face mask (only `box` is touched)."""
+    w, h = img.size
+    radius = max(w, h) * 0.004
+    sbox = expand_box(box, 3 * (int(radius) + 2) + 2, w, h)
+    img_sharp = img.crop(sbox).filter(ImageFilter.UnsharpMask(radius=radius, percent=180, threshold=2))
+    inner = (box[0] - sbox[0], box[1] - sbox[1], box[2] - sbox[0], box[3] - sbox[1])
+    img.paste(Image.composite(img_sharp.crop(inner), img.crop(box), face), box[:2])
+    return img
+
+
+def enhanced_base(source, box, cfg=None):
+    """Full-resolution enhanced base and ROI face mask, rebuilt from the source image bytes.
+
+    The mask comes from the mask cache (built once per resolution; the contour map is not
+    needed here and never built). The base is pixel-identical to the base_enhanced.png the
+    full decode mode hands over.
+    """
+    img = open_rgb(source)
+    w, h = img.size
+    face = get_mask_cache(cfg).get(face_key(w, h, box), lambda: {"face": tight_face_mask((w, h), box)})["face"]
+    return enhance(img, box, face), face
+
+
+def reduced_size(input_path, cfg):
+    """(source size, generation size) when the A-pass may work at reduced resolution, else None.
+
+    a_pass.decode "reduced" only applies when the B-pass uploads at generation size anyway:
+    the full-resolution pixels are then needed only for the final recomposite, which
+    rebuilds them from the source bytes carried in the artifacts (enhanced_base).
+    """
+    cfg = cfg or {}
+    if (cfg.get("a_pass") or {}).get("decode", "full") != "reduced":
+        return None
+    if not (cfg.get("b_pass") or {}).get("send_at_target_size", False):
+        return None
+    w, h = probe_size(input_path)
+    size = generation_size(w, h)
+    if size == (w, h):
+        return None
+    return (w, h), size
+
+
+def decode_input(input_path, gen_size=None):
+    """(RGB image, source bytes) for the A-pass.
+
+    With gen_size (reduced decode) the image comes out at generation size and the input's
+    bytes are returned for the final recomposite; otherwise the image is full size and
+    source is None.
+    """
+    if not gen_size:
+        return open_rgb(input_path), None
+    with open(input_path, "rb") as f:
+        source = f.read()
+    # libjpeg skips to the smallest 1/2^n scale still >= the generation size
+    img = open_rgb(source, gen_size)
+    if img.size != gen_size:
+        img = img.resize(gen_size, Image.LANCZOS)
+    return img, source
+
+
+def run(input_path, workdir, cfg=None, keep_intermediates=None):
+    """Run the A-pass and return the artifacts as encoded PNG bytes for the B-pass.
+
+    Returns {"size": (w, h), "base": bytes, "face": bytes, "contour": bytes}. The artifacts
+    are also written under `workdir` when keep_intermediates is on. In reduced decode mode
+    the images are at generation size and "size" is still the source size; "source" (the
+    input file's bytes) and "source_box" are what the B-pass recomposites with. The work dir
+    records only where the input is and its hash; a B-pass-only rerun reads it from there.
+    """
+    ac = (cfg or {}).get("a_pass") or {}
+    if keep_intermediates is None:
+        keep_intermediates = bool(ac.get("keep_intermediates", True))
+    level = int(ac.get("png_compress_level", 1))
+
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    src_size, gen_size = reduced_size(input_path, cfg) or (None, None)
+    with spans.span("a.decode", image=name, reduced=bool(gen_size)):
+        img, source = decode_input(input_path, gen_size)
     w, h = img.size
+    box = work_box(w, h, ac)
 
-    # Face mask
-    face = tight_face_mask(img)
-    face_path = os.path.join(args.workdir, "masks", "face_mask.png")
-    face.save(face_path)
+    # Face mask and contour map (geometry only, cached per resolution)
+    key = geometry_key(w, h, box)
+    with spans.span("a.geometry", image=name):
+        face = get_mask_cache(cfg).get(key, lambda: face_geometry(w, h, box))["face"]
+        face_png, contour_png = geometry_png(key, w, h, box, level)
 
     # Base image enhancement: unsharp only on face area
-    base_path = os.path.join(args.workdir, "a_pass", "base_enhanced.png")
-    img_sharp = img.filter(ImageFilter.UnsharpMask(radius=max(w, h) * 0.004, percent=180, threshold=2))
-    base_enhanced = Image.composite(img_sharp, img, face)
-    base_enhanced.save(base_path)
+    with spans.span("a.unsharp", image=name):
+        enhance(img, box, face)
+    with spans.span("a.base_png", image=name) as sp:
+        base_png = encode_png(img, level)
+        sp["bytes_out"] = len(base_png)
+
+    artifacts = {"size": src_size or (w, h), "base": base_png, "face": face_png, "contour": contour_png}
+    if gen_size:
+        sw, sh = src_size
+        src_box = work_box(sw, sh, ac)
+        artifacts["source"] = source
+        artifacts["source_box"] = src_box
+    if keep_intermediates:
+        paths = []
+        with spans.span("a.write", image=name) as sp:
+            for art, rel in ARTIFACT_PATHS.items():
+                path = os.path.join(workdir, rel)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(artifacts[art])
+                sp.add("bytes_out", len(artifacts[art]))
+                paths.append(path)
+            meta_path = os.path.join(workdir, SOURCE_META)
+            if gen_size:
+                # The input is not copied: the B-pass re-reads it, and the hash catches a changed file
+                st = os.stat(input_path)
+                meta = {"input": os.path.abspath(input_path), "sha256": hashlib.sha256(source).hexdigest(),
+                        "bytes": st.st_size, "mtime_ns": st.st_mtime_ns, "size": list(src_size), "box": list(src_box)}
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump(meta, f)
+                paths.append(meta_path)
+            elif os.path.exists(meta_path):
+                os.remove(meta_path)
+        print("[A-PASS] Saved:", *paths)
+    else:
+        print("[A-PASS] Done:", input_path)
+    return artifacts
 
-    # Contour map for ControlNet2
-    white = Image.new("L", (w, h), 255)
-    
-    # Base: face oval stroke and jawline
-    oval = ellipse_stroke_mask(w, h, int(w * 0.50), int(h * 0.50), int(w * 0.24), int(h * 0.30), width_rel=0.0032, blur_rel=0.010)
-    jaw = line_mask(w, h, [(int(w * 0.38), int(h * 0.64)), (int(w * 0.50), int(h * 0.648)), (int(w * 0.62), int(h * 0.64))], width_rel=0.0032, blur_rel=0.012)
-
-    # Temples / hairline short arcs
-    temple_L = line_mask(w, h, [(int(w * 0.30), int(h * 0.28)), (int(w * 0.28), int(h * 0.24)), (int(w * 0.32), int(h * 0.22))], width_rel=0.003, blur_rel=0.012)
-    temple_R = line_mask(w, h, [(int(w * 0.70), int(h * 0.28)), (int(w * 0.72), int(h * 0.24)), (int(w * 0.68), int(h * 0.22))], width_rel=0.003, blur_rel=0.012)
-
-    # Cheekbone accent lines
-    cheek_main_L = line_mask(w, h, [(int(w * 0.33), int(h * 0.56)), (int(w * 0.40), int(h * 0.59)), (int(w * 0.46), int(h * 0.58))], width_rel=0.0060, blur_rel=0.005)
-    cheek_main_R = line_mask(w, h, [(int(w * 0.67), int(h * 0.56)), (int(w * 0.60), int(h * 0.59)), (int(w * 0.54), int(h * 0.58))], width_rel=0.0060, blur_rel=0.005)
-    cheek_upper_L = line_mask(w, h, [(int(w * 0.36), int(h * 0.50)), (int(w * 0.42), int(h * 0.52)), (int(w * 0.48), int(h * 0.51))], width_rel=0.0042, blur_rel=0.005)
-    cheek_upper_R = line_mask(w, h, [(int(w * 0.64), int(h * 0.50)), (int(w * 0.58), int(h * 0.52)), (int(w * 0.52), int(h * 0.51))], width_rel=0.0042, blur_rel=0.005)
-    cheek_ridge_L = line_mask(w, h, [(int(w * 0.33), int(h * 0.54)), (int(w * 0.40), int(h * 0.565)), (int(w * 0.47), int(h * 0.555))], width_rel=0.0030, blur_rel=0.004)
-    cheek_ridge_R = line_mask(w, h, [(int(w * 0.67), int(h * 0.54)), (int(w * 0.60), int(h * 0.565)), (int(w * 0.53), int(h * 0.555))], width_rel=0.0030, blur_rel=0.004)
-
-    # Cheek shadow line toward mouth corners
-    cheek_shadow_L = line_mask(w, h, [(int(w * 0.42), int(h * 0.60)), (int(w * 0.46), int(h * 0.62)), (int(w * 0.48), int(h * 0.64))], width_rel=0.0042, blur_rel=0.009)
-    cheek_shadow_R = line_mask(w, h, [(int(w * 0.58), int(h * 0.60)), (int(w * 0.54), int(h * 0.62)), (int(w * 0.52), int(h * 0.64))], width_rel=0.0042, blur_rel=0.009)
-
-    # Forehead soft edge
-    forehead_edge = line_mask(w, h, [(int(w * 0.38), int(h * 0.26)), (int(w * 0.50), int(h * 0.24)), (int(w * 0.62), int(h * 0.26))], width_rel=0.0028, blur_rel=0.012)
-
-    # Eyelids and crow's feet
-    upper_lid_L = line_mask(w, h, [(int(w * 0.40), int(h * 0.41)), (int(w * 0.45), int(h * 0.405)), (int(w * 0.50), int(h * 0.41))], width_rel=0.0034, blur_rel=0.006)
-    lower_lid_L = line_mask(w, h, [(int(w * 0.40), int(h * 0.43)), (int(w * 0.45), int(h * 0.435)), (int(w * 0.50), int(h * 0.43))], width_rel=0.0029, blur_rel=0.006)
-    upper_lid_R = line_mask(w, h, [(int(w * 0.60), int(h * 0.41)), (int(w * 0.55), int(h * 0.405)), (int(w * 0.50), int(h * 0.41))], width_rel=0.0034, blur_rel=0.006)
-    lower_lid_R = line_mask(w, h, [(int(w * 0.60), int(h * 0.43)), (int(w * 0.55), int(h * 0.435)), (int(w * 0.50), int(h * 0.43))], width_rel=0.0029, blur_rel=0.006)
-    crow_L = line_mask(w, h, [(int(w * 0.50), int(h * 0.42)), (int(w * 0.52), int(h * 0.425)), (int(w * 0.535), int(h * 0.43))], width_rel=0.0024, blur_rel=0.010)
-    crow_R = line_mask(w, h, [(int(w * 0.50), int(h * 0.42)), (int(w * 0.48), int(h * 0.425)), (int(w * 0.465), int(h * 0.43))], width_rel=0.0024, blur_rel=0.010)
-
-    # Nose features
-    nose_bridge = line_mask(w, h, [(int(w * 0.50), int(h * 0.38)), (int(w * 0.50), int(h * 0.52))], width_rel=0.0032, blur_rel=0.006)
-    nose_tip_hi = ellipse_stroke_mask(w, h, int(w * 0.50), int(h * 0.55), int(w * 0.020), int(h * 0.012), width_rel=0.0030, blur_rel=0.007)
-    nose_L = line_mask(w, h, [(int(w * 0.488), int(h * 0.47)), (int(w * 0.486), int(h * 0.53))], width_rel=0.0030, blur_rel=0.008)
-    nose_R = line_mask(w, h, [(int(w * 0.512), int(h * 0.47)), (int(w * 0.514), int(h * 0.53))], width_rel=0.0030, blur_rel=0.008)
-
-    # Lips contours
-    upper_lip = line_mask(w, h, [(int(w * 0.44), int(h * 0.62)), (int(w * 0.50), int(h * 0.615)), (int(w * 0.56), int(h * 0.62))], width_rel=0.0042, blur_rel=0.009)
-    lower_lip = line_mask(w, h, [(int(w * 0.44), int(h * 0.63)), (int(w * 0.50), int(h * 0.635)), (int(w * 0.56), int(h * 0.63))], width_rel=0.0038, blur_rel=0.009)
-    cupid_bow = line_mask(w, h, [(int(w * 0.485), int(h * 0.615)), (int(w * 0.50), int(h * 0.610)), (int(w * 0.515), int(h * 0.615))], width_rel=0.0036, blur_rel=0.008)
-
-    # Nasolabial folds and marionette lines
-    naso_L = line_mask(w, h, [(int(w * 0.485), int(h * 0.56)), (int(w * 0.47), int(h * 0.60))], width_rel=0.0030, blur_rel=0.011)
-    naso_R = line_mask(w, h, [(int(w * 0.515), int(h * 0.56)), (int(w * 0.53), int(h * 0.60))], width_rel=0.0030, blur_rel=0.011)
-    marionette_L = line_mask(w, h, [(int(w * 0.47), int(h * 0.64)), (int(w * 0.47), int(h * 0.66))], width_rel=0.0028, blur_rel=0.011)
-    marionette_R = line_mask(w, h, [(int(w * 0.53), int(h * 0.64)), (int(w * 0.53), int(h * 0.66))], width_rel=0.0028, blur_rel=0.011)
-
-    # Under-chin line and neck shading
-    under_chin = line_mask(w, h, [(int(w * 0.44), int(h * 0.655)), (int(w * 0.50), int(h * 0.66)), (int(w * 0.56), int(h * 0.655))], width_rel=0.0028, blur_rel=0.014)
-    neck_vert_L = line_mask(w, h, [(int(w * 0.46), int(h * 0.67)), (int(w * 0.46), int(h * 0.64))], width_rel=0.0022, blur_rel=0.014)
-    neck_vert_R = line_mask(w, h, [(int(w * 0.54), int(h * 0.67)), (int(w * 0.54), int(h * 0.64))], width_rel=0.0022, blur_rel=0.014)
-
-    lines = union(
-        oval, jaw,
-        temple_L, temple_R,
-        cheek_main_L, cheek_main_R, cheek_upper_L, cheek_upper_R, cheek_ridge_L, cheek_ridge_R, cheek_shadow_L, cheek_shadow_R,
-        forehead_edge,
-        upper_lid_L, lower_lid_L, upper_lid_R, lower_lid_R, crow_L, crow_R,
-        nose_bridge, nose_tip_hi, nose_L, nose_R,
-        upper_lip, lower_lip, cupid_bow, naso_L, naso_R, marionette_L, marionette_R,
-        under_chin, neck_vert_L, neck_vert_R,
-    )
-    
-    lines = ImageChops.multiply(lines, face)
-    inv = ImageOps.invert(lines)
-    contour = Image.composite(Image.new("L", (w, h), 0), white, lines)
-    contour = contour.filter(ImageFilter.GaussianBlur(radius=0))
 
-    contour_path = os.path.join(args.workdir, "a_pass", "contour_map.png")
-    contour.save(contour_path)
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", default="config.yaml")
+    ap.add_argument("--input", required=True)
+    ap.add_argument("--workdir", default="work")
+    args = ap.parse_args()
 
-    print("[A-PASS] Saved:", base_path, face_path, contour_path)
+    cfg = {}
+    if os.path.exists(args.config):
+        with open(args.config, "r", encoding="utf-8") as f:
+            cfg = yaml.safe_load(f) or {}
+    run(args.input, args.workdir, cfg, keep_intermediates=True)
 
 
 if __name__ == "__main__":
@@ -1,51 +1,153 @@
 
 import os
 import io
+import json
+import time
 import base64
+import hashlib
 import argparse
 import yaml
-import requests
 from PIL import Image
 
+import spans
+import writer
+from a1111_client import A1111Client, BackendError  # noqa: F401  (BackendError re-exported)
+from decode import generation_size, png_size
+from run_a_pass import ARTIFACT_PATHS, encode_png, enhanced_base, read_source, source_meta
+
 
 def load_cfg(path):
     with open(path, "r", encoding="utf-8") as f:
         return yaml.safe_load(f)
 
 
-def img_to_b64(path):
-    with Image.open(path) as im:
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_bytes(data):
+    """PNG-encoded bytes for `data`; existing PNG bytes are passed through without decoding."""
+    if data.startswith(PNG_SIGNATURE):
+        return data
+    with Image.open(io.BytesIO(data)) as im:
         buf = io.BytesIO()
-        im.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
+        im.save(buf, format="PNG", compress_level=1)
+        return buf.getvalue()
 
 
-def run_a1111(cfg, a_pass_image, face_mask_path, contour_map_path, out_path):
-    ep = cfg["general"]["a1111_endpoint"]
-    bp = cfg["b_pass"]
+def img_to_b64(path_or_bytes):
+    if isinstance(path_or_bytes, (bytes, bytearray)):
+        data = bytes(path_or_bytes)
+    else:
+        with open(path_or_bytes, "rb") as f:
+            data = f.read()
+    return base64.b64encode(png_bytes(data)).decode("utf-8")
+
+
+def load_artifacts(workdir):
+    """Read A-pass artifacts written with keep_intermediates back as raw bytes."""
+    artifacts = {}
+    for name, rel in ARTIFACT_PATHS.items():
+        path = os.path.join(workdir, rel)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                artifacts[name] = f.read()
+    # Reduced decode mode: images are at generation size, the final composite re-reads the input
+    meta = source_meta(workdir)
+    if meta:
+        artifacts["source"] = read_source(meta)
+        artifacts["size"], artifacts["source_box"] = tuple(meta["size"]), tuple(meta["box"])
+    return artifacts
+
 
-    init_b64 = img_to_b64(a_pass_image)
-    mask_b64 = img_to_b64(face_mask_path)
-    contour_b64 = img_to_b64(contour_map_path) if os.path.exists(contour_map_path) else init_b64
+def b64_len(n):
+    return 4 * ((n + 2) // 3)
+
+
+def resized_png(data, size, resample):
+    if png_size(data) == tuple(size):
+        return data
+    with Image.open(io.BytesIO(data)) as im:
+        return encode_png(im.resize(size, resample))
+
+
+def encode_images(cfg, artifacts, name=None):
+    """Base64 image fields for one image's payloads, plus the sizes and savings build_payload reports.
+
+    Depends only on the artifacts and b_pass.send_at_target_size, so callers building several
+    payloads for one image (sweep.py) encode once and pass the result to build_payload.
+    """
+    bp = cfg["b_pass"]
 
     # Safe dimensions (<= 768 and multiples of 64)
     try:
-        with Image.open(a_pass_image) as size_probe:
-            src_w, src_h = size_probe.size
+        if "size" in artifacts:
+            src_w, src_h = artifacts["size"]
+        else:
+            with Image.open(io.BytesIO(artifacts["base"])) as size_probe:
+                src_w, src_h = size_probe.size
     except Exception:
         src_w, src_h = (768, 768)
 
-    def to_multiple_of_64(value: float) -> int:
-        return max(256, (int(value) // 64) * 64)
+    tgt_w, tgt_h = generation_size(src_w, src_h)
 
-    max_side = 768
-    scale = min(1.0, float(max_side) / float(max(src_w, src_h) or 1))
-    tgt_w = to_multiple_of_64(src_w * scale)
-    tgt_h = to_multiple_of_64(src_h * scale)
+    # Optionally upload at generation size; save_result scales the output back up.
+    # Reduced-decode artifacts are already at generation size and always go this way.
+    sources = {name: artifacts[name] for name in ("base", "face", "contour") if artifacts.get(name)}
+    downsize = bool(bp.get("send_at_target_size", False) or artifacts.get("source")) and (tgt_w, tgt_h) != (src_w, src_h)
+    if downsize:
+        tgt = (int(tgt_w), int(tgt_h))
+        with spans.span("b.resize", image=name) as sp:
+            sources = {n: resized_png(data, tgt, Image.LANCZOS if n == "base" else Image.BILINEAR) for n, data in sources.items()}
+            sp["bytes_out"] = sum(len(data) for data in sources.values())
 
-    payload = {
-        "init_images": [init_b64],
+    area = (src_w * src_h) / float(tgt_w * tgt_h) if downsize and artifacts.get("source") else 1.0
+
+    with spans.span("b.b64", image=name) as sp:
+        init_b64 = img_to_b64(sources["base"])
+        mask_b64 = img_to_b64(sources["face"])
+        contour_b64 = img_to_b64(sources["contour"]) if sources.get("contour") else init_b64
+        sp["bytes_out"] = len(init_b64) + len(mask_b64) + (len(contour_b64) if sources.get("contour") else 0)
+
+    return {
+        "src_size": (src_w, src_h),
+        "size": (tgt_w, tgt_h),
+        "downsized": downsize,
+        "init": init_b64,
         "mask": mask_b64,
+        "contour": contour_b64,
+        # What the image fields would weigh at source resolution, for reporting savings
+        # (scaled by area for reduced-decode artifacts, which never exist at full size)
+        "saved_b64_bytes": sum(b64_len(int(len(artifacts[n]) * area)) - b64_len(len(sources[n])) for n in sources),
+    }
+
+
+def build_payload(cfg, artifacts, name=None, images=None, dispatched=False):
+    """img2img payload for one image plus the context save_result needs to finish it.
+
+    `images` is a result of encode_images() for these artifacts; it is computed when omitted.
+    dispatched=True means the request goes through a Dispatcher, which loads the checkpoint
+    itself under general.checkpoint_affinity; anything else keeps the per-request override.
+    """
+    bp = cfg["b_pass"]
+    images = images or encode_images(cfg, artifacts, name)
+    tgt_w, tgt_h = images["size"]
+
+    # With checkpoint affinity the dispatcher sets the model once per backend via /sdapi/v1/options
+    checkpoint = cfg["general"].get("model_checkpoint") or None
+    affinity_mode = dispatched and bool(cfg["general"].get("checkpoint_affinity", False))
+
+    ctx = {
+        "src_size": images["src_size"],
+        "downsized": images["downsized"],
+        "artifacts": artifacts,
+        "a_pass": cfg.get("a_pass") or {},
+        "output": writer.settings(cfg),
+        "saved_b64_bytes": images["saved_b64_bytes"],
+    }
+
+    payload = {
+        "init_images": [images["init"]],
+        "mask": images["mask"],
         "prompt": bp.get("prompt", ""),
         "negative_prompt": bp.get("negative", ""),
         "denoising_strength": float(bp["denoise"]),
@@ -61,9 +163,9 @@ def run_a1111(cfg, a_pass_image, face_mask_path, contour_map_path, out_path):
         "inpainting_mask_invert": 0,
         "mask_blur": int(bp["mask_blur_px"]),
         "override_settings": {
-            **({"sd_model_checkpoint": cfg["general"].get("model_checkpoint")} if cfg["general"].get("model_checkpoint") else {})
+            **({"sd_model_checkpoint": checkpoint} if checkpoint and not affinity_mode else {})
         },
-        "override_settings_restore_afterwards": True,
+        "override_settings_restore_afterwards": not affinity_mode,
         "alwayson_scripts": {}
     }
 
@@ -118,7 +220,7 @@ def run_a1111(cfg, a_pass_image, face_mask_path, contour_map_path, out_path):
 
     if bp.get("use_controlnet2", False):
         cn2_model = bp.get("controlnet2_model") or "xinsirControlnetCanny_v20"
-        cn2_image_b64 = f"data:image/png;base64,{contour_b64}"
+        cn2_image_b64 = f"data:image/png;base64,{images['contour']}"
         cn_args.append({
             "enabled": True,
             "module": bp.get("controlnet2_module", "canny"),
@@ -137,18 +239,151 @@ def run_a1111(cfg, a_pass_image, face_mask_path, contour_map_path, out_path):
     if cn_args:
         payload["alwayson_scripts"]["ControlNet"] = {"args": cn_args}
 
-    r = requests.post(f"{ep}/sdapi/v1/img2img", json=payload, timeout=900)
+    if affinity_mode:
+        ctx["affinity"] = (checkpoint, tuple(a["model"] for a in cn_args))
+
+    return payload, ctx
+
+
+def finish(raw, ctx):
+    """Full-size final image for one returned image: upscaled and blended back under the face mask.
+
+    The face mask is zero outside its box, so only the box can change: just that part of the
+    result is upscaled, never the whole frame.
+    """
+    art = ctx["artifacts"]
+    if art.get("source"):
+        # Reduced decode: rebuild the full-res base from the source bytes the A-pass carried
+        box = tuple(art["source_box"])
+        base, face = enhanced_base(art["source"], box, {"a_pass": ctx.get("a_pass")})
+    else:
+        with Image.open(io.BytesIO(art["base"])) as im:
+            base = im.convert("RGB")
+        with Image.open(io.BytesIO(art["face"])) as im:
+            face = im.convert("L")
+        box = face.getbbox()
+        if box is None:
+            return base
+        face = face.crop(box)
+    x0, y0, x1, y1 = box
+    with Image.open(io.BytesIO(raw)) as out:
+        out = out.convert("RGB")
+    sx, sy = out.width / float(base.width), out.height / float(base.height)
+    if (sx, sy) == (1.0, 1.0):
+        region = out.crop(box)
+    else:
+        region = out.resize((x1 - x0, y1 - y0), Image.LANCZOS, box=(x0 * sx, y0 * sy, x1 * sx, y1 * sy))
+    base.paste(Image.composite(region, base.crop(box), face), box[:2])
+    return base
+
+
+def save_result(img_b64, ctx, out_path):
+    """Queue one returned image on the background writer and return its Future (out_path once written).
+
+    Only the base64 decode happens here, on the caller's (dispatcher) thread; upscaling, the
+    full-resolution recomposite (finish) and encoding run on the writer, after the backend
+    slot is released.
+    """
+    name = ctx.get("name")
+    with spans.span("b.decode", image=name) as sp:
+        raw = base64.b64decode(img_b64.split(",", 1)[-1])
+        sp["bytes_out"] = len(raw)
+    out_writer = writer.get_writer(ctx.get("output"))
+    if not ctx["downsized"]:
+        return out_writer.submit(raw, out_path, name)
+    return out_writer.submit(lambda: finish(raw, ctx), out_path, name)
+
+
+def wait_written(stats):
+    """Block until the outputs behind post_img2img stats are on disk; re-raises write errors."""
+    for st in stats:
+        written = st.pop("written", None)
+        if written is not None:
+            written.result()
+    return stats
+
+
+def batch_key(payload, ctx=None):
+    """Requests with equal keys differ only in init_images and can share one img2img call."""
+    rest = {k: v for k, v in payload.items() if k != "init_images"}
+    rest["_affinity"] = (ctx or {}).get("affinity")
+    return hashlib.sha1(json.dumps(rest, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def post_img2img(client, prepared, retry=True):
+    """Send prepared (payload, ctx) pairs sharing one batch_key as a single img2img call.
+
+    Several pairs go out as one request with multiple init_images and a matching batch_size;
+    the returned images are split back to each ctx["out_path"] in order. Files are written in
+    the background; wait_written(stats) blocks until they are on disk. retry=False leaves
+    retrying to the caller (the dispatcher requeues failed jobs on another backend).
+    """
+    n = len(prepared)
+    payload = prepared[0][0]
+    if n > 1:
+        payload = dict(payload, init_images=[p["init_images"][0] for p, _ in prepared], batch_size=n)
+    names = [ctx.get("name") for _, ctx in prepared]
+    with spans.span("b.json", images=names) as sp:
+        body = json.dumps(payload).encode("utf-8")
+        sp["bytes_out"] = len(body)
+
+    t0 = time.perf_counter()
+    with spans.span("b.http", images=names, backend=client.url, batch=n, bytes_sent=len(body)) as sp:
+        r = client.img2img(body, retry=retry)
+        sp["status"] = r.status_code
+    rtt = time.perf_counter() - t0
     if r.status_code != 200:
-        raise RuntimeError(f"img2img failed HTTP {r.status_code}: {r.text[:1000]}")
+        raise BackendError(f"img2img failed HTTP {r.status_code}: {r.text[:1000]}")
     
     data = r.json()
-    if "images" not in data or not data["images"]:
-        raise RuntimeError("No images from A1111")
+    images = data.get("images") or []
+    if not images:
+        raise BackendError("No images from A1111")
+    # ControlNet may append its detected maps after the generated images
+    if len(images) < n:
+        raise BackendError(f"Expected {n} images from A1111, got {len(images)}")
     
-    img_b64 = data["images"][0].split(",", 1)[-1]
-    with open(out_path, "wb") as f:
-        f.write(base64.b64decode(img_b64))
-    print(f"[B-PASS] Saved: {out_path}")
+    stats = []
+    for img_b64, (_, ctx) in zip(images, prepared):
+        out_path = ctx["out_path"]
+        written = save_result(img_b64, ctx, out_path)
+        stats.append({"out_path": out_path, "written": written, "request_bytes": len(body) // n, "saved_bytes": ctx["saved_b64_bytes"], "rtt_s": rtt, "batch": n})
+        print(f"[B-PASS] Saved: {out_path} (request {len(body) / n / 1e6:.2f} MB, saved {ctx['saved_b64_bytes'] / 1e6:.2f} MB, {rtt:.2f}s round trip, batch of {n})")
+    return stats
+
+
+def make_client(cfg, endpoint=None, session=None):
+    return A1111Client.from_cfg(cfg, endpoint or cfg["general"]["a1111_endpoint"], session=session)
+
+
+def run_a1111(cfg, artifacts, out_path, session=None, endpoint=None, client=None):
+    payload, ctx = build_payload(cfg, artifacts)
+    ctx["out_path"] = out_path
+    return wait_written(post_img2img(client or make_client(cfg, endpoint, session), [(payload, ctx)]))[0]
+
+
+def prepare(cfg, workdir, output, artifacts=None, dispatched=False):
+    """Build the img2img request for one work dir. `artifacts` from run_a_pass.run skips reading the work dir.
+
+    dispatched: the request will be submitted to a Dispatcher (see build_payload).
+    """
+    if artifacts is None:
+        artifacts = load_artifacts(workdir)
+    os.makedirs(output, exist_ok=True)
+    
+    input_name = os.path.basename(os.path.normpath(workdir)) or "final"
+    payload, ctx = build_payload(cfg, artifacts, input_name, dispatched=dispatched)
+    ctx["name"] = input_name
+    ctx["out_path"] = writer.output_path(cfg, output, input_name)
+    return payload, ctx
+
+
+def run(cfg, workdir, output, session=None, endpoint=None, artifacts=None, client=None):
+    """B-pass for one work dir."""
+    prepared = prepare(cfg, workdir, output, artifacts)
+    client = client or make_client(cfg, endpoint, session)
+    client.ensure_ready()
+    return wait_written(post_img2img(client, [prepared]))[0]
 
 
 def main():
@@ -159,15 +394,7 @@ def main():
     args = ap.parse_args()
 
     cfg = load_cfg(args.config)
-    a_pass_image = os.path.join(args.workdir, "a_pass", "base_enhanced.png")
-    face_mask_path = os.path.join(args.workdir, "masks", "face_mask.png")
-    contour_map_path = os.path.join(args.workdir, "a_pass", "contour_map.png")
-    os.makedirs(args.output, exist_ok=True)
-    
-    input_name = os.path.basename(os.path.normpath(args.workdir)) or "final"
-    out_path = os.path.join(args.output, f"{input_name}.png")
-
-    run_a1111(cfg, a_pass_image, face_mask_path, contour_map_path, out_path)
+    run(cfg, args.workdir, args.output)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+
+import os
+import json
+import time
+
+import numpy as np
+
+# Append-only fd of the JSONL trace; None while tracing is off
+_fd = None
+_path = None
+_run_id = None
+
+
+class _NoSpan:
+    """Shared stand-in returned by span() when tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+    def add(self, key, value):
+        pass
+
+
+NOOP = _NoSpan()
+
+
+class Span(dict):
+    """Timed stage. Extra fields (image, backend, bytes_out, bytes_sent, ...) are set like dict items."""
+
+    def __init__(self, name, attrs):
+        super().__init__(attrs)
+        self.name = name
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        self._c0 = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        rec = {"run": _run_id, "span": self.name, "ts": time.time(), "pid": os.getpid(),
+               "wall_s": time.perf_counter() - self._t0, "cpu_s": time.thread_time() - self._c0, **self}
+        if exc_type is not None:
+            rec["error"] = exc_type.__name__
+        emit(rec)
+        return False
+
+    def add(self, key, value):
+        self[key] = self.get(key, 0) + value
+
+
+def configure(path, run_id=None):
+    """Start appending spans to `path` (None or "" turns tracing off). Also used as a pool initializer."""
+    global _fd, _path, _run_id
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+    _path, _run_id = path or None, run_id
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+
+def enabled():
+    return _fd is not None
+
+
+def settings():
+    """(path, run_id) to hand to configure() in worker processes."""
+    return _path, _run_id
+
+
+def span(name, **attrs):
+    if _fd is None:
+        return NOOP
+    return Span(name, attrs)
+
+
+def emit(rec):
+    # One write() per line on an O_APPEND fd, so threads and pool workers never interleave
+    if _fd is not None:
+        os.write(_fd, (json.dumps(rec, default=str) + "\n").encode("utf-8"))
+
+
+def load(path, run_id=None):
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if run_id is None or rec.get("run") == run_id:
+                records.append(rec)
+    return records
+
+
+def summarize(records):
+    """Per span name: count, wall/cpu totals and percentiles, bytes, backends."""
+    by_name = {}
+    for rec in records:
+        by_name.setdefault(rec["span"], []).append(rec)
+    out = {}
+    for name, recs in by_name.items():
+        wall = np.asarray([r["wall_s"] for r in recs])
+        out[name] = {
+            "count": len(recs),
+            "errors": sum(1 for r in recs if "error" in r),
+            "wall_s": float(wall.sum()),
+            "cpu_s": float(sum(r["cpu_s"] for r in recs)),
+            "p50_s": float(np.percentile(wall, 50)),
+            "p95_s": float(np.percentile(wall, 95)),
+            "bytes_out": int(sum(r.get("bytes_out", 0) for r in recs)),
+            "bytes_sent": int(sum(r.get("bytes_sent", 0) for r in recs)),
+            "backends": sorted({r["backend"] for r in recs if r.get("backend")}),
+        }
+    return out
+
+
+def print_summary(records):
+    stats = summarize(records)
+    if not stats:
+        return
+    print(f"\n[TRACE] {'stage':<22} {'count':>6} {'wall s':>9} {'cpu s':>9} {'p50 s':>8} {'p95 s':>8} {'out MB':>8} {'sent MB':>8}")
+    for name in sorted(stats):
+        s = stats[name]
+        print(f"[TRACE] {name:<22} {s['count']:>6} {s['wall_s']:>9.2f} {s['cpu_s']:>9.2f} {s['p50_s']:>8.3f} {s['p95_s']:>8.3f} "
+              f"{s['bytes_out'] / 1e6:>8.2f} {s['bytes_sent'] / 1e6:>8.2f}")
+    backends = {}
+    for rec in records:
+        if rec.get("backend"):
+            backends[rec["backend"]] = backends.get(rec["backend"], 0) + 1
+    for url, n in sorted(backends.items()):
+        print(f"[TRACE] backend {url}: {n} spans")
+
+
+def _label_value(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**kv):
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in kv.items()) + "}"
+
+
+def write_prometheus(path, records, prefix="preset_contour"):
+    """Write the run's stage metrics in the node exporter textfile format (atomically)."""
+    stats = summarize(records)
+    lines = [
+        f"# HELP {prefix}_stage_seconds Wall time per pipeline stage in the last batch run.",
+        f"# TYPE {prefix}_stage_seconds summary",
+    ]
+    for name, s in sorted(stats.items()):
+        lines.append(f"{prefix}_stage_seconds{_labels(stage=name, quantile='0.5')} {s['p50_s']:.6f}")
+        lines.append(f"{prefix}_stage_seconds{_labels(stage=name, quantile='0.95')} {s['p95_s']:.6f}")
+        lines.append(f"{prefix}_stage_seconds_sum{_labels(stage=name)} {s['wall_s']:.6f}")
+        lines.append(f"{prefix}_stage_seconds_count{_labels(stage=name)} {s['count']}")
+    for metric, key, help_text in (
+        ("stage_cpu_seconds", "cpu_s", "CPU time per pipeline stage in the last batch run."),
+        ("stage_bytes_out", "bytes_out", "Bytes encoded per pipeline stage in the last batch run."),
+        ("stage_bytes_sent", "bytes_sent", "Bytes sent to A1111 per pipeline stage in the last batch run."),
+        ("stage_errors", "errors", "Failed spans per pipeline stage in the last batch run."),
+    ):
+        lines += [f"# HELP {prefix}_{metric} {help_text}", f"# TYPE {prefix}_{metric} gauge"]
+        lines += [f"{prefix}_{metric}{_labels(stage=name)} {s[key]}" for name, s in sorted(stats.items())]
+    backends = {}
+    for rec in records:
+        if rec.get("backend"):
+            key = (rec["backend"], rec["span"])
+            backends[key] = backends.get(key, 0) + 1
+    lines += [f"# HELP {prefix}_backend_spans Spans served per A1111 backend in the last batch run.",
+              f"# TYPE {prefix}_backend_spans gauge"]
+    lines += [f"{prefix}_backend_spans{_labels(backend=url, stage=name)} {n}" for (url, name), n in sorted(backends.items())]
+    lines += [f"# HELP {prefix}_last_run_timestamp_seconds End of the last traced batch run.",
+              f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+              f"{prefix}_last_run_timestamp_seconds {time.time():.0f}"]
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
@@ -0,0 +1,131 @@
+
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+# kind "line":    points = [(x, y), ...] as fractions of (w, h)
+# kind "ellipse": points = [(cx, cy), (rx, ry)] as fractions of (w, h); drawn as a thin ring
+Stroke = namedtuple("Stroke", "name kind points width_rel blur_rel")
+
+CONTOUR_STROKES = [
+    # Base: face oval stroke and jawline
+    Stroke("oval", "ellipse", [(0.50, 0.50), (0.24, 0.30)], 0.0032, 0.010),
+    Stroke("jaw", "line", [(0.38, 0.64), (0.50, 0.648), (0.62, 0.64)], 0.0032, 0.012),
+
+    # Temples / hairline short arcs
+    Stroke("temple_L", "line", [(0.30, 0.28), (0.28, 0.24), (0.32, 0.22)], 0.003, 0.012),
+    Stroke("temple_R", "line", [(0.70, 0.28), (0.72, 0.24), (0.68, 0.22)], 0.003, 0.012),
+
+    # Cheekbone accent lines
+    Stroke("cheek_main_L", "line", [(0.33, 0.56), (0.40, 0.59), (0.46, 0.58)], 0.0060, 0.005),
+    Stroke("cheek_main_R", "line", [(0.67, 0.56), (0.60, 0.59), (0.54, 0.58)], 0.0060, 0.005),
+    Stroke("cheek_upper_L", "line", [(0.36, 0.50), (0.42, 0.52), (0.48, 0.51)], 0.0042, 0.005),
+    Stroke("cheek_upper_R", "line", [(0.64, 0.50), (0.58, 0.52), (0.52, 0.51)], 0.0042, 0.005),
+    Stroke("cheek_ridge_L", "line", [(0.33, 0.54), (0.40, 0.565), (0.47, 0.555)], 0.0030, 0.004),
+    Stroke("cheek_ridge_R", "line", [(0.67, 0.54), (0.60, 0.565), (0.53, 0.555)], 0.0030, 0.004),
+
+    # Cheek shadow line toward mouth corners
+    Stroke("cheek_shadow_L", "line", [(0.42, 0.60), (0.46, 0.62), (0.48, 0.64)], 0.0042, 0.009),
+    Stroke("cheek_shadow_R", "line", [(0.58, 0.60), (0.54, 0.62), (0.52, 0.64)], 0.0042, 0.009),
+
+    # Forehead soft edge
+    Stroke("forehead_edge", "line", [(0.38, 0.26), (0.50, 0.24), (0.62, 0.26)], 0.0028, 0.012),
+
+    # Eyelids and crow's feet
+    Stroke("upper_lid_L", "line", [(0.40, 0.41), (0.45, 0.405), (0.50, 0.41)], 0.0034, 0.006),
+    Stroke("lower_lid_L", "line", [(0.40, 0.43), (0.45, 0.435), (0.50, 0.43)], 0.0029, 0.006),
+    Stroke("upper_lid_R", "line", [(0.60, 0.41), (0.55, 0.405), (0.50, 0.41)], 0.0034, 0.006),
+    Stroke("lower_lid_R", "line", [(0.60, 0.43), (0.55, 0.435), (0.50, 0.43)], 0.0029, 0.006),
+    Stroke("crow_L", "line", [(0.50, 0.42), (0.52, 0.425), (0.535, 0.43)], 0.0024, 0.010),
+    Stroke("crow_R", "line", [(0.50, 0.42), (0.48, 0.425), (0.465, 0.43)], 0.0024, 0.010),
+
+    # Nose features
+    Stroke("nose_bridge", "line", [(0.50, 0.38), (0.50, 0.52)], 0.0032, 0.006),
+    Stroke("nose_tip_hi", "ellipse", [(0.50, 0.55), (0.020, 0.012)], 0.0030, 0.007),
+    Stroke("nose_L", "line", [(0.488, 0.47), (0.486, 0.53)], 0.0030, 0.008),
+    Stroke("nose_R", "line", [(0.512, 0.47), (0.514, 0.53)], 0.0030, 0.008),
+
+    # Lips contours
+    Stroke("upper_lip", "line", [(0.44, 0.62), (0.50, 0.615), (0.56, 0.62)], 0.0042, 0.009),
+    Stroke("lower_lip", "line", [(0.44, 0.63), (0.50, 0.635), (0.56, 0.63)], 0.0038, 0.009),
+    Stroke("cupid_bow", "line", [(0.485, 0.615), (0.50, 0.610), (0.515, 0.615)], 0.0036, 0.008),
+
+    # Nasolabial folds and marionette lines
+    Stroke("naso_L", "line", [(0.485, 0.56), (0.47, 0.60)], 0.0030, 0.011),
+    Stroke("naso_R", "line", [(0.515, 0.56), (0.53, 0.60)], 0.0030, 0.011),
+    Stroke("marionette_L", "line", [(0.47, 0.64), (0.47, 0.66)], 0.0028, 0.011),
+    Stroke("marionette_R", "line", [(0.53, 0.64), (0.53, 0.66)], 0.0028, 0.011),
+
+    # Under-chin line and neck shading
+    Stroke("under_chin", "line", [(0.44, 0.655), (0.50, 0.66), (0.56, 0.655)], 0.0028, 0.014),
+    Stroke("neck_vert_L", "line", [(0.46, 0.67), (0.46, 0.64)], 0.0022, 0.014),
+    Stroke("neck_vert_R", "line", [(0.54, 0.67), (0.54, 0.64)], 0.0022, 0.014),
+
+]
+
+
+def _stroke_geometry(s, w, h):
+    lw = max(1, int(min(w, h) * s.width_rel))
+    radius = int(max(w, h) * s.blur_rel)
+    if s.kind == "line":
+        pts = [(int(w * x), int(h * y)) for x, y in s.points]
+        xs, ys = [p[0] for p in pts], [p[1] for p in pts]
+        extent = (min(xs) - lw, min(ys) - lw, max(xs) + lw, max(ys) + lw)
+    elif s.kind == "ellipse":
+        (fx, fy), (frx, fry) = s.points
+        cx, cy, rx, ry = int(w * fx), int(h * fy), int(w * frx), int(h * fry)
+        pts = (cx, cy, rx, ry)
+        extent = (cx - rx - 1, cy - ry - 1, cx + rx + 1, cy + ry + 1)
+    else:
+        raise ValueError(f"unknown stroke kind: {s.kind}")
+    # Pillow's Gaussian is three box passes; pixels beyond ~3 * radius stay exactly zero
+    pad = 3 * (radius + 1) + 2
+    x0, y0, x1, y1 = extent
+    bbox = (max(0, x0 - pad), max(0, y0 - pad), min(w, x1 + pad + 1), min(h, y1 + pad + 1))
+    return pts, lw, radius, bbox
+
+
+def render_stroke(s, w, h):
+    """Draw and blur one stroke inside its padded bounding box.
+
+    Returns (patch, (x0, y0)) where patch is a uint8 array in frame coordinates offset by (x0, y0),
+    or None when the stroke falls outside the frame.
+    """
+    pts, lw, radius, (x0, y0, x1, y1) = _stroke_geometry(s, w, h)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    size = (x1 - x0, y1 - y0)
+    if s.kind == "line":
+        m = Image.new("L", size, 0)
+        ImageDraw.Draw(m).line([(x - x0, y - y0) for x, y in pts], fill=255, width=lw, joint="curve")
+    else:
+        cx, cy, rx, ry = pts
+        cx, cy = cx - x0, cy - y0
+        outer = Image.new("L", size, 0)
+        inner = Image.new("L", size, 0)
+        ImageDraw.Draw(outer).ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=255)
+        ImageDraw.Draw(inner).ellipse([cx - rx + lw, cy - ry + lw, cx + rx - lw, cy + ry - lw], fill=255)
+        m = ImageChops.subtract(outer, inner)
+    m = m.filter(ImageFilter.GaussianBlur(radius=radius))
+    return np.asarray(m), (x0, y0)
+
+
+def render_strokes(w, h, strokes=CONTOUR_STROKES, box=None):
+    """Max-composite all strokes into one "L" buffer covering `box` (default: the whole frame)."""
+    bx0, by0, bx1, by1 = box or (0, 0, w, h)
+    buf = np.zeros((by1 - by0, bx1 - bx0), dtype=np.uint8)
+    for s in strokes:
+        rendered = render_stroke(s, w, h)
+        if rendered is None:
+            continue
+        patch, (px, py) = rendered
+        ph, pw = patch.shape
+        # Intersect patch with the output box
+        ix0, iy0 = max(px, bx0), max(py, by0)
+        ix1, iy1 = min(px + pw, bx1), min(py + ph, by1)
+        if ix1 <= ix0 or iy1 <= iy0:
+            continue
+        dst = buf[iy0 - by0:iy1 - by0, ix0 - bx0:ix1 - bx0]
+        np.maximum(dst, patch[iy0 - py:iy1 - py, ix0 - px:ix1 - px], out=dst)
+    return Image.fromarray(buf)
@@ -0,0 +1,243 @@
+
+import os
+import csv
+import copy
+import glob
+import json
+import random
+import hashlib
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+import run_a_pass
+import run_b_pass
+import writer
+from batch import IMAGE_PATTERNS, load_cfg, submit_b
+from dispatch import Dispatcher
+
+
+def parse_params(specs, cfg):
+    """--param name=v1,v2,... (grid values) or name=lo:hi (range, for --random) -> {name: values or (lo, hi)}."""
+    params = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        name = name.strip()
+        if not values:
+            raise SystemExit(f"--param {spec!r}: expected name=v1,v2 or name=lo:hi")
+        if name not in cfg["b_pass"]:
+            print(f"[SWEEP] Note: b_pass.{name} is not in the config; adding it")
+        cast = type(cfg["b_pass"].get(name, 0.0))
+        if cast is bool:
+            cast = lambda v: str(v).lower() in ("1", "true", "yes")
+        if ":" in values and "," not in values:
+            lo, hi = (float(v) for v in values.split(":", 1))
+            params[name] = (lo, hi, cast)
+        else:
+            params[name] = [cast(scalar(v)) for v in values.split(",")]
+    return params
+
+
+def scalar(v):
+    v = v.strip()
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+
+def variants(params, n_random=0, seed=0):
+    """Full grid over list params, or n_random samples (uniform within ranges, random choice from lists)."""
+    names = list(params)
+    if not n_random:
+        ranged = [n for n in names if isinstance(params[n], tuple)]
+        if ranged:
+            raise SystemExit(f"ranges ({', '.join(ranged)}) need --random N")
+        return [dict(zip(names, combo)) for combo in itertools.product(*(params[n] for n in names))]
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n_random):
+        v = {}
+        for n in names:
+            p = params[n]
+            if isinstance(p, tuple):
+                lo, hi, cast = p
+                x = rng.uniform(lo, hi)
+                v[n] = int(round(x)) if cast is int else round(x, 3)
+            else:
+                v[n] = rng.choice(p)
+        out.append(v)
+    return out
+
+
+def payload_hash(payload, ctx):
+    data = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data + repr(ctx.get("affinity")).encode("utf-8")).hexdigest()
+
+
+def contact_sheet(rows, params, path, thumb=256):
+    """Grid of one image's variant renders, labelled with the variant's b_pass values."""
+    done = [r for r in rows if r["status"] == "done"]
+    if not done:
+        return
+    cols = min(4, len(done))
+    label_h = 14 * (len(params) + 1) + 4
+    sheet = Image.new("RGB", (cols * thumb, -(-len(done) // cols) * (thumb + label_h)), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for i, r in enumerate(done):
+        x, y = (i % cols) * thumb, (i // cols) * (thumb + label_h)
+        with Image.open(r["output"]) as im:
+            im.thumbnail((thumb, thumb))
+            sheet.paste(im.convert("RGB"), (x + (thumb - im.width) // 2, y))
+        lines = [r["variant"]] + [f"{n}={r[n]}" for n in params]
+        for j, line in enumerate(lines):
+            draw.text((x + 4, y + thumb + 2 + 14 * j), line, fill=(0, 0, 0))
+    sheet.save(path, quality=90)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Render b_pass parameter variants; each image's A-pass runs once.")
+    ap.add_argument("--config", default="config.yaml")
+    ap.add_argument("--param", action="append", default=[], metavar="NAME=V1,V2|LO:HI",
+                    help="b_pass key to sweep; repeat for several keys")
+    ap.add_argument("--random", type=int, default=0, help="sample N variants instead of the full grid")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--images", nargs="*", help="inputs (default: io.input_dir)")
+    ap.add_argument("--limit", type=int, default=0, help="use only the first N inputs")
+    ap.add_argument("--out", default="sweep", help="output dir for renders, sweep.csv and contact sheets")
+    args = ap.parse_args()
+
+    cfg = load_cfg(args.config)
+    if not args.param:
+        raise SystemExit("nothing to sweep: pass at least one --param, e.g. --param controlnet_weight=0.55,0.6,0.65")
+    params = parse_params(args.param, cfg)
+    combos = variants(params, args.random, args.seed)
+
+    imgs = args.images
+    if not imgs:
+        imgs = sorted(sum((glob.glob(os.path.join(cfg["io"]["input_dir"], ext)) for ext in IMAGE_PATTERNS), []))
+    if args.limit:
+        imgs = imgs[:args.limit]
+    if not imgs:
+        print("No images to sweep")
+        return
+
+    renders = os.path.join(args.out, "renders")
+    os.makedirs(renders, exist_ok=True)
+    print(f"[SWEEP] {len(imgs)} image(s) x {len(combos)} variant(s)")
+
+    # A-pass once per image, in parallel
+    a_workers = max(1, int((cfg.get("batch") or {}).get("a_workers", 2)))
+    with ProcessPoolExecutor(max_workers=a_workers) as pool:
+        futures = [pool.submit(run_a_pass.run, img, os.path.join(cfg["io"]["work_dir"], os.path.splitext(os.path.basename(img))[0]), cfg, False) for img in imgs]
+        artifacts = [f.result() for f in futures]
+
+    rows, seen = [], {}
+
+    def plan():
+        """Yield (variant index, payload, ctx) per render still to do, recording a row for every pair.
+
+        Payloads are built only as the dispatcher takes them. Variant-major order keeps same-variant
+        images adjacent so they can share a call; each image's base64 fields are encoded once and
+        reused by every variant.
+        """
+        encoded = {}
+        for i, combo in enumerate(combos):
+            vcfg = copy.deepcopy(cfg)
+            vcfg["b_pass"].update(combo)
+            for img, art in zip(imgs, artifacts):
+                name = os.path.splitext(os.path.basename(img))[0]
+                # Resizing before upload is the only b_pass key the image fields depend on
+                ekey = (img, bool(vcfg["b_pass"].get("send_at_target_size", False)))
+                if ekey not in encoded:
+                    encoded[ekey] = run_b_pass.encode_images(vcfg, art, name)
+                payload, ctx = run_b_pass.build_payload(vcfg, art, name, encoded[ekey], dispatched=True)
+                digest = payload_hash(payload, ctx)
+                out = writer.output_path(cfg, renders, f"{name}_{digest[:16]}")
+                row = {"image": name, "variant": f"v{i:03d}", **combo, "payload_hash": digest, "output": out}
+                rows.append(row)
+                # Equal payloads render identically: skip anything rendered before or already queued
+                if os.path.exists(out):
+                    row["render"] = "cached"
+                elif digest in seen:
+                    row["render"] = "duplicate"
+                else:
+                    ctx.update(name=name, out_path=out, payload_hash=digest)
+                    seen[digest] = row
+                    row["render"] = "new"
+                    yield i, payload, ctx
+
+    def collect(fut, chunk):
+        try:
+            stats = fut.result()
+        except Exception as e:
+            stats = [e] * len(chunk)
+        for (_, ctx), st in zip(chunk, stats):
+            # Each render succeeds or fails on its own write
+            try:
+                if isinstance(st, Exception):
+                    raise st
+                run_b_pass.wait_written([st])
+            except Exception as e:
+                print(f"[FAILED] {ctx['name']} {os.path.basename(ctx['out_path'])}: {e}")
+                seen[ctx["payload_hash"]].update(status="failed", error=str(e)[:500])
+                continue
+            seen[ctx["payload_hash"]].update(status="done", rtt_s=round(st["rtt_s"], 3), request_bytes=st["request_bytes"])
+
+    bc = cfg.get("batch") or {}
+    batch_size = max(1, int(bc.get("img2img_batch_size", 2)))
+    queue_size = max(1, int(bc.get("queue_size", a_workers * 2)))
+    with Dispatcher.from_cfg(cfg) as dispatcher:
+        # Variants fan out over every backend slot; same-size images of one variant share a call.
+        # At most capacity + queue_size calls are queued, so only their payloads are in memory.
+        in_flight = deque()
+
+        def submit(chunk):
+            while len(in_flight) >= dispatcher.capacity + queue_size:
+                collect(*in_flight.popleft())
+            in_flight.append((submit_b(dispatcher, chunk), chunk))
+
+        groups, variant = {}, None
+        for i, payload, ctx in plan():
+            if i != variant:
+                # Later variants never join these groups
+                for chunk in groups.values():
+                    submit(chunk)
+                groups, variant = {}, i
+            key = run_b_pass.batch_key(payload, ctx)
+            groups.setdefault(key, []).append((payload, ctx))
+            if len(groups[key]) >= batch_size:
+                submit(groups.pop(key))
+        for chunk in groups.values():
+            submit(chunk)
+        while in_flight:
+            collect(*in_flight.popleft())
+
+    print(f"[SWEEP] {sum(r['render'] == 'new' for r in rows)} new render(s), "
+          f"{sum(r['render'] == 'cached' for r in rows)} already rendered, "
+          f"{sum(r['render'] == 'duplicate' for r in rows)} duplicate payload(s) skipped")
+    # Rows were recorded variant by variant; report them per image
+    order = {os.path.splitext(os.path.basename(img))[0]: n for n, img in enumerate(imgs)}
+    rows.sort(key=lambda r: (order[r["image"]], r["variant"]))
+
+    for row in rows:
+        if row["render"] != "new":
+            row["status"] = "done" if os.path.exists(row["output"]) else "failed"
+
+    fields = ["image", "variant", *params, "payload_hash", "render", "status", "output", "rtt_s", "request_bytes", "error"]
+    csv_path = os.path.join(args.out, "sweep.csv")
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        w.writeheader()
+        w.writerows(rows)
+
+    for name in dict.fromkeys(r["image"] for r in rows):
+        contact_sheet([r for r in rows if r["image"] == name], params, os.path.join(args.out, f"contact_{name}.jpg"))
+    print(f"[SWEEP] Results -> {csv_path}, contact sheets in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+
+import os
+import json
+import time
+import heapq
+import signal
+import fnmatch
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import run_a_pass
+import run_b_pass
+import spans
+import writer
+from batch import IMAGE_PATTERNS, RunLog, load_cfg, submit_b, job_name
+from dispatch import Dispatcher
+from manifest import Manifest
+
+
+def _worker_init(trace_path, run_id):
+    # The daemon drains on SIGINT/SIGTERM; workers must finish their current image instead of dying with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    spans.configure(trace_path, run_id)
+
+
+class Watcher:
+    """Watch-folder daemon: keeps the config, A-pass workers (and their mask caches) and the
+    backend pool warm, and processes images as they land in io.input_dir.
+
+    A file is queued once its size and mtime have been stable for watch.settle_s, so partially
+    written uploads are not picked up. Queued files run by priority (watch.priorities, first
+    matching glob wins, lower first), then in arrival order. A failed image is requeued after
+    watch.retry_s (doubling per attempt, capped at watch.retry_max_s) up to watch.max_attempts
+    times, so a backend outage delays images instead of dropping them; changing the file
+    resets its attempts.
+    """
+
+    def __init__(self, cfg, dispatcher, pool, log, manifest=None):
+        wc = cfg.get("watch") or {}
+        bc = cfg.get("batch") or {}
+        self.cfg = cfg
+        self.dispatcher = dispatcher
+        self.pool = pool
+        self.log = log
+        self.manifest = manifest
+        self.input_dir = cfg["io"]["input_dir"]
+        self.work_dir = cfg["io"]["work_dir"]
+        self.out_dir = cfg["io"]["output_dir"]
+        self.poll_s = float(wc.get("poll_s", 2))
+        self.settle_s = float(wc.get("settle_s", 3))
+        self.status_s = float(wc.get("status_s", 30))
+        self.status_file = wc.get("status_file") or None
+        self.prometheus = wc.get("prometheus") or None
+        self.priorities = [(r["glob"], int(r["priority"])) for r in wc.get("priorities") or []]
+        self.default_priority = int(wc.get("default_priority", 10))
+        self.queue_size = max(1, int(bc.get("queue_size", 4)))
+        self.batch_size = max(1, int(bc.get("img2img_batch_size", 2)))
+        self.linger_s = float(bc.get("linger_s", 0.5))
+        self.max_attempts = max(1, int(wc.get("max_attempts", 3)))
+        self.retry_s = float(wc.get("retry_s", 30))
+        self.retry_max_s = float(wc.get("retry_max_s", 600))
+
+        self.seen = {}       # path -> (size, mtime_ns) already queued
+        self.settling = {}   # path -> ((size, mtime_ns), first seen with that signature)
+        self.queue = []      # heap of (priority, seq, job)
+        self.paths = {}      # job name -> input path
+        self.attempts = {}   # path -> (signature, failed attempts)
+        self.retry_at = {}   # path -> time a failed image may be queued again
+        self.seq = 0
+        self.a_inflight = []  # (job, future)
+        self.b_inflight = []  # (future, group)
+        self.groups = {}
+        self.group_since = {}  # key -> time its first image became ready
+        self.skipped = 0
+        self.finished = deque()  # completion times, for throughput
+        self.started = time.time()
+        self.draining = False
+        self._last_status = 0.0
+
+    def priority(self, path):
+        name = os.path.basename(path)
+        for pattern, prio in self.priorities:
+            if fnmatch.fnmatch(name, pattern):
+                return prio
+        return self.default_priority
+
+    def scan(self):
+        now = time.time()
+        present = set(list_images(self.input_dir))
+        for path in sorted(present):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if self.seen.get(path) == sig or self.retry_at.get(path, 0) > now:
+                continue
+            prev = self.settling.get(path)
+            if prev is None or prev[0] != sig:
+                self.settling[path] = (sig, now)
+                continue
+            # Unchanged across polls and not written to for settle_s
+            if now - prev[1] >= self.settle_s and now - st.st_mtime_ns / 1e9 >= self.settle_s:
+                del self.settling[path]
+                self.seen[path] = sig
+                self.retry_at.pop(path, None)
+                if self.attempts.get(path, (sig,))[0] != sig:
+                    self.attempts.pop(path)
+                self.enqueue(path)
+        for path in list(self.settling):
+            if path not in present:
+                del self.settling[path]
+        for table in (self.seen, self.attempts, self.retry_at):
+            for path in list(table):
+                if path not in present:
+                    del table[path]
+
+    def enqueue(self, img):
+        name = os.path.splitext(os.path.basename(img))[0]
+        wd = os.path.join(self.work_dir, name)
+        need_a = True
+        if self.manifest:
+            artifacts_exist = run_a_pass.artifacts_complete(wd)
+            plan = self.manifest.plan(name, img, self.log.a_hash, self.log.b_hash, writer.output_path(self.cfg, self.out_dir, name), artifacts_exist)
+            if plan == "skip":
+                self.skipped += 1
+                return
+            need_a = plan == "ab"
+        self.paths[name] = img
+        prio = self.priority(img)
+        self.seq += 1
+        heapq.heappush(self.queue, (prio, self.seq, (img, wd, need_a)))
+        print(f"[WATCH] Queued {img} (priority {prio}, {'full' if need_a else 'B-pass only'})")
+
+    def start_jobs(self):
+        # Bounded like the batch pipeline: at most queue_size A-pass results waiting, B-pass capped too
+        while (self.queue and not self.draining and len(self.a_inflight) < self.queue_size
+               and len(self.b_inflight) < self.dispatcher.capacity + self.queue_size):
+            _, _, job = heapq.heappop(self.queue)
+            img, wd, need_a = job
+            keep = True if self.manifest else None
+            fut = self.pool.submit(run_a_pass.run, img, wd, self.cfg, keep) if need_a else None
+            self.a_inflight.append((job, fut))
+
+    def harvest(self):
+        still = []
+        for job, fut in self.a_inflight:
+            if fut is not None and not fut.done():
+                still.append((job, fut))
+                continue
+            img, wd, _ = job
+            name = job_name(wd)
+            try:
+                artifacts = fut.result() if fut else None
+                if fut:
+                    self.log.a_done(name)
+                prepared = run_b_pass.prepare(self.cfg, wd, self.out_dir, artifacts, dispatched=True)
+            except Exception as e:
+                if fut:
+                    self.log.a_failed(name, e)
+                else:
+                    self.log.b_failed([name], e)
+                self.failed(name)
+                self.finished.append(time.time())
+                continue
+            key = run_b_pass.batch_key(*prepared)
+            self.groups.setdefault(key, []).append(prepared)
+            self.group_since.setdefault(key, time.time())
+            if len(self.groups[key]) >= self.batch_size:
+                self.flush(key)
+        self.a_inflight = still
+        # Partial batches go out when nothing else is on its way, or when the backends sit idle
+        # and the batch has waited linger_s for another image
+        idle = all(f.done() for f, _ in self.b_inflight)
+        for key in list(self.groups):
+            if not self.a_inflight or (idle and time.time() - self.group_since[key] >= self.linger_s):
+                self.flush(key)
+
+        still = []
+        for fut, group in self.b_inflight:
+            if not fut.done():
+                still.append((fut, group))
+                continue
+            failed = self.log.collect(fut, group)
+            for _, ctx in group:
+                if ctx["name"] in failed:
+                    self.failed(ctx["name"])
+                else:
+                    self.succeeded(ctx["name"])
+            now = time.time()
+            self.finished.extend([now] * len(group))
+        self.b_inflight = still
+
+    def failed(self, name):
+        img = self.paths.pop(name, None)
+        sig = self.seen.get(img)
+        if img is None or sig is None:
+            return
+        prev_sig, n = self.attempts.get(img, (sig, 0))
+        n = n + 1 if prev_sig == sig else 1
+        self.attempts[img] = (sig, n)
+        if n >= self.max_attempts:
+            print(f"[WATCH] Giving up on {img} after {n} attempt(s); replace or touch the file to retry")
+            return
+        delay = min(self.retry_max_s, self.retry_s * 2 ** (n - 1))
+        # Forget it was queued: scan() picks it up again once the delay has passed
+        del self.seen[img]
+        self.retry_at[img] = time.time() + delay
+        print(f"[WATCH] Retrying {img} in {delay:.0f}s (attempt {n + 1}/{self.max_attempts})")
+
+    def succeeded(self, name):
+        img = self.paths.pop(name, None)
+        self.attempts.pop(img, None)
+
+    def flush(self, key):
+        group = self.groups.pop(key)
+        self.group_since.pop(key, None)
+        self.b_inflight.append((submit_b(self.dispatcher, group), group))
+
+    def busy(self):
+        return bool(self.a_inflight or self.b_inflight or self.groups)
+
+    def futures(self):
+        return [f for _, f in self.a_inflight if f is not None] + [f for f, _ in self.b_inflight]
+
+    def status(self):
+        now = time.time()
+        window = 300.0
+        while self.finished and now - self.finished[0] > window:
+            self.finished.popleft()
+        span = min(window, now - self.started) or 1.0
+        return {
+            "time": now,
+            "uptime_s": round(now - self.started, 1),
+            "draining": self.draining,
+            "queued": len(self.queue),
+            "settling": len(self.settling),
+            "a_pass": len(self.a_inflight),
+            "b_pass": len(self.b_inflight) + sum(len(g) for g in self.groups.values()),
+            "retrying": len(self.retry_at),
+            "done": self.log.n_done,
+            "failed": self.log.n_failed,
+            "skipped": self.skipped,
+            "images_per_min": round(len(self.finished) * 60.0 / span, 2),
+        }
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_status < self.status_s:
+            return
+        self._last_status = now
+        st = self.status()
+        print(f"[WATCH] queued {st['queued']} (+{st['settling']} settling, {st['retrying']} waiting to retry), A-pass {st['a_pass']}, B-pass {st['b_pass']}, "
+              f"done {st['done']}, failed {st['failed']}, up to date {st['skipped']}, {st['images_per_min']:.1f} img/min")
+        if self.status_file:
+            write_atomic(self.status_file, json.dumps(st, indent=2) + "\n")
+        if self.prometheus:
+            write_atomic(self.prometheus, prometheus_text(st))
+
+    def run(self):
+        print(f"[WATCH] Watching {self.input_dir} every {self.poll_s:g}s (settle {self.settle_s:g}s); SIGTERM drains and exits")
+        while True:
+            if not self.draining:
+                self.scan()
+            self.start_jobs()
+            self.harvest()
+            if self.draining and not self.busy():
+                break
+            self.report()
+            pending = self.futures()
+            timeout = self.poll_s
+            if self.groups:
+                # Wake up in time to send a lingering partial batch
+                timeout = min(timeout, max(0.05, min(self.group_since.values()) + self.linger_s - time.time()))
+            if pending:
+                wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
+        self.report(force=True)
+        if self.queue:
+            print(f"[WATCH] {len(self.queue)} queued image(s) left for the next start")
+
+    def drain(self, signum=None, frame=None):
+        if self.draining:
+            # Second signal: stop waiting for in-flight work; the manifest retries it next start
+            print("\n[WATCH] Second signal, exiting without draining")
+            # Workers ignore signals so a drain lets them finish; they would outlive os._exit
+            for proc in list((getattr(self.pool, "_processes", None) or {}).values()):
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            os._exit(130)
+        print(f"\n[WATCH] Signal {signum}: finishing {len(self.a_inflight)} A-pass and {len(self.b_inflight)} B-pass job(s), then exiting")
+        self.draining = True
+
+
+def list_images(directory):
+    # Case-insensitive: uploads arrive as .JPG as often as .jpg; dotfiles are in-progress copies
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, n) for n in names
+            if not n.startswith(".") and any(fnmatch.fnmatch(n.lower(), p) for p in IMAGE_PATTERNS)]
+
+
+def write_atomic(path, text):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def prometheus_text(st, prefix="preset_contour_watch"):
+    lines = [
+        f"# HELP {prefix}_queue_depth Images waiting or in progress per stage.",
+        f"# TYPE {prefix}_queue_depth gauge",
+    ]
+    lines += [f'{prefix}_queue_depth{{stage="{k}"}} {st[k]}' for k in ("settling", "retrying", "queued", "a_pass", "b_pass")]
+    lines += [f"# HELP {prefix}_images Images finished since the daemon started.", f"# TYPE {prefix}_images gauge"]
+    lines += [f'{prefix}_images{{status="{k}"}} {st[k]}' for k in ("done", "failed", "skipped")]
+    lines += [
+        f"# HELP {prefix}_images_per_minute Throughput over the last 5 minutes.",
+        f"# TYPE {prefix}_images_per_minute gauge",
+        f"{prefix}_images_per_minute {st['images_per_min']}",
+        f"# HELP {prefix}_draining 1 while the daemon finishes in-flight work before exiting.",
+        f"# TYPE {prefix}_draining gauge",
+        f"{prefix}_draining {int(st['draining'])}",
+        f"# HELP {prefix}_uptime_seconds Seconds since the daemon started.",
+        f"# TYPE {prefix}_uptime_seconds gauge",
+        f"{prefix}_uptime_seconds {st['uptime_s']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Process images as they arrive in io.input_dir.")
+    ap.add_argument("--config", default="config.yaml")
+    ap.add_argument("--trace", help="append per-stage spans to this JSONL file (overrides trace.path)")
+    args = ap.parse_args()
+    cfg = load_cfg(args.config)
+    os.makedirs(cfg["io"]["output_dir"], exist_ok=True)
+
+    trace_path = args.trace or (cfg.get("trace") or {}).get("path")
+    if trace_path:
+        spans.configure(trace_path, run_id=f"watch-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}")
+
+    manifest_path = (cfg.get("batch") or {}).get("manifest")
+    manifest = Manifest(manifest_path) if manifest_path else None
+    log = RunLog(cfg, manifest, history=1000)
+    a_workers = max(1, int((cfg.get("batch") or {}).get("a_workers", 2)))
+
+    with Dispatcher.from_cfg(cfg) as dispatcher, \
+            ProcessPoolExecutor(max_workers=a_workers, initializer=_worker_init, initargs=spans.settings()) as pool:
+        watcher = Watcher(cfg, dispatcher, pool, log, manifest)
+        signal.signal(signal.SIGTERM, watcher.drain)
+        signal.signal(signal.SIGINT, watcher.drain)
+        watcher.run()
+
+    if manifest:
+        manifest.close()
+    print("[WATCH] Stopped.")
+
+
+if __name__ == "__main__":
+    main()
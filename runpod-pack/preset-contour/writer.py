@@ -0,0 +1,108 @@
+
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import spans
+
+# output.format -> file extension
+FORMATS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+_writers = {}
+_lock = threading.Lock()
+
+
+def settings(cfg):
+    """Normalized output section: format, compress_level, quality, writers."""
+    oc = (cfg or {}).get("output") or {}
+    fmt = str(oc.get("format", "png")).lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in FORMATS:
+        raise ValueError(f"output.format must be one of {', '.join(FORMATS)}, got {fmt!r}")
+    return {
+        "format": fmt,
+        "compress_level": int(oc.get("compress_level", 1)),
+        "quality": int(oc.get("quality", 95)),
+        "writers": max(1, int(oc.get("writers", 1))),
+    }
+
+
+def output_path(cfg, out_dir, name):
+    return os.path.join(out_dir, name + FORMATS[settings(cfg)["format"]])
+
+
+class OutputWriter:
+    """Finishes, encodes and writes final images on background threads.
+
+    The B-pass hands over the decoded result and gets its dispatcher slot back straight away;
+    the full-resolution recomposite and the PNG/WebP encode (the largest CPU costs per image)
+    overlap the next render. submit() never blocks: queued jobs hold only the small result
+    bytes, full-resolution images exist only while a writer thread works on them. Files appear
+    atomically, so a crash never leaves a truncated output that looks finished.
+    """
+
+    def __init__(self, format="png", compress_level=1, quality=95, writers=1):
+        self.format = format
+        self.compress_level = compress_level
+        self.quality = quality
+        self._pool = ThreadPoolExecutor(max_workers=writers, thread_name_prefix="writer")
+
+    def save_kwargs(self):
+        if self.format == "png":
+            return {"format": "PNG", "compress_level": self.compress_level}
+        if self.format == "webp":
+            # compress_level doubles as the WebP method (0 fast .. 6 small)
+            return {"format": "WEBP", "quality": self.quality, "method": min(6, self.compress_level)}
+        return {"format": "JPEG", "quality": self.quality, "subsampling": 0}
+
+    def submit(self, image, path, name=None):
+        """Queue a PIL image, PNG bytes straight from A1111, or a callable returning a PIL image
+        (run on the writer thread) for `path`. Returns a Future."""
+        return self._pool.submit(self._write, image, path, name)
+
+    def _write(self, image, path, name):
+        if callable(image):
+            with spans.span("b.save", image=name):
+                image = image()
+        with spans.span("b.write", image=name, format=self.format) as sp:
+            if isinstance(image, (bytes, bytearray)):
+                if self.format == "png" and image[:8] == b"\x89PNG\r\n\x1a\n":
+                    data = bytes(image)
+                else:
+                    with Image.open(io.BytesIO(image)) as im:
+                        data = self.encode(im.convert("RGB"))
+            else:
+                data = self.encode(image)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            sp["bytes_out"] = len(data)
+        return path
+
+    def encode(self, im):
+        buf = io.BytesIO()
+        im.save(buf, **self.save_kwargs())
+        return buf.getvalue()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+def get_writer(output=None):
+    """Process-wide writer for normalized `output` settings (see settings())."""
+    output = output or settings(None)
+    key = tuple(sorted(output.items()))
+    with _lock:
+        if key not in _writers:
+            _writers[key] = OutputWriter(**output)
+        return _writers[key]